@@ -0,0 +1,55 @@
+"""Benchmark bulk import and export throughput.
+
+Generates a synthetic tree of files, imports it into a scratch database and
+exports it back out with varying numbers of workers, printing files per
+second and MB per second for each run.
+
+    python benchmarks/bulk.py [--files N] [--size BYTES] [--workers 1 4 16]
+"""
+import argparse
+import os
+import os.path
+import tempfile
+from mongocontents import MongoContents
+from mongocontents.bulk import export_tree, import_tree
+
+
+def make_tree(root, files, size, per_directory=100):
+    for i in range(files):
+        directory = os.path.join(root, 'dir{:04d}'.format(i // per_directory))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'file{:06d}.txt'.format(i)),
+                  'w') as f:
+            f.write(('{:06d} '.format(i) * (size // 7 + 1))[:size])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mongodb-uri', default='mongodb://localhost:27017')
+    parser.add_argument('--database', default='jupyter_benchmark')
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=16 * 1024)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'source')
+        make_tree(source, args.files, args.size)
+        for workers in args.workers:
+            contents = MongoContents(mongodb_uri=args.mongodb_uri,
+                                     database_name=args.database)
+            contents._client.drop_database(args.database)
+            contents = MongoContents(mongodb_uri=args.mongodb_uri,
+                                     database_name=args.database)
+            stats = import_tree(contents, source, workers=workers,
+                                force=True)
+            print('import workers={:<3d} {}'.format(workers, stats))
+            dest = os.path.join(tmp, 'export{}'.format(workers))
+            stats = export_tree(contents, '', dest, workers=workers,
+                                resume=False)
+            print('export workers={:<3d} {}'.format(workers, stats))
+        contents._client.drop_database(args.database)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+"""Multi-user load test of the /api/contents REST endpoints.
+
+Starts a notebook server using MongoContents against a local mongod (or
+targets an already running one with --url), seeds a dataset for every
+simulated user and has each user repeatedly list directories, open, autosave,
+rename and upload files in the configured proportions. Reports throughput,
+latency percentiles per operation and the number of MongoDB operations
+performed (from serverStatus opcounters). Exits with an error if any request
+failed, since failed requests make the timings meaningless.
+
+    python benchmarks/load.py [--users N] [--duration SECONDS]
+        [--mix list=30,open=25,autosave=35,rename=5,upload=5 | --mix edit]
+        [--dirs N] [--files N] [--cells N] [--file-size BYTES]
+
+With --smoke, every user makes each operation once instead, which checks that
+all of them succeed against the server in a few seconds.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+import requests
+from pymongo import MongoClient
+from mongocontents import MongoContents
+
+# named workload mixes, as relative weights of each operation
+MIXES = {
+    # a typical session: mostly autosaves of open notebooks, some browsing
+    'default': {'list': 30, 'open': 25, 'autosave': 35, 'rename': 5,
+                'upload': 5},
+    # many users browsing and opening, few edits
+    'browse': {'list': 55, 'open': 40, 'autosave': 5},
+    # everyone editing at once
+    'edit': {'open': 10, 'autosave': 85, 'rename': 5},
+    # moving data in
+    'upload': {'list': 10, 'upload': 90},
+}
+
+OPERATIONS = ['list', 'open', 'autosave', 'rename', 'upload']
+
+
+def parse_mix(value):
+    if value in MIXES:
+        return MIXES[value]
+    mix = {}
+    for item in value.split(','):
+        operation, _, weight = item.partition('=')
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(
+                "unknown operation {!r}".format(operation))
+        mix[operation] = float(weight)
+    return mix
+
+
+def notebook(cells, salt=''):
+    return {
+        'metadata': {},
+        'nbformat': 4,
+        'nbformat_minor': 4,
+        'cells': [{'cell_type': 'code', 'metadata': {}, 'outputs': [],
+                   'execution_count': None,
+                   'source': 'x = {}\nprint(x){}'.format(i, salt)}
+                  for i in range(cells)],
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, token):
+    """Start a notebook server using MongoContents; returns (process, url)."""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'notebook', '--no-browser',
+         '--port={}'.format(port), '--ip=127.0.0.1',
+         '--NotebookApp.token={}'.format(token),
+         '--NotebookApp.contents_manager_class=mongocontents.MongoContents',
+         '--MongoContents.mongodb_uri={}'.format(args.mongodb_uri),
+         '--MongoContents.database_name={}'.format(args.database)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:{}'.format(port)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            response = requests.get(
+                url + '/api/contents',
+                headers={'Authorization': 'token ' + token}, timeout=1)
+            if response.status_code == 200:
+                return process, url
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("notebook server did not start")
+
+
+def seed(args, users):
+    """Create each user's directories, notebooks and text files directly
+    through MongoContents (seeding is not measured)."""
+    contents = MongoContents(mongodb_uri=args.mongodb_uri,
+                             database_name=args.database)
+    text = 'x' * args.file_size
+    for user in users:
+        contents.save({'type': 'directory'}, user)
+        for d in range(args.dirs):
+            directory = '{}/dir{}'.format(user, d)
+            contents.save({'type': 'directory'}, directory)
+            for f in range(args.files):
+                contents.save({'type': 'notebook',
+                               'content': notebook(args.cells)},
+                              '{}/nb{}.ipynb'.format(directory, f))
+                contents.save({'type': 'file', 'format': 'text',
+                               'mimetype': 'text/plain', 'content': text},
+                              '{}/file{}.txt'.format(directory, f))
+
+
+class User(threading.Thread):
+    """A simulated user working in their own directory."""
+
+    def __init__(self, name, args, url, token, mix, stop, seed):
+        super().__init__(daemon=True)
+        self.name = name
+        self.args = args
+        self.url = url + '/api/contents/'
+        self.stop = stop
+        self.random = random.Random(seed)
+        self.operations = list(mix.keys())
+        self.weights = list(mix.values())
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'token ' + token
+        # (operation, seconds, status) for every request made; status is None
+        # if the request failed without a response
+        self.samples = []
+        self.notebooks = ['{}/dir{}/nb{}.ipynb'.format(name, d, f)
+                          for d in range(args.dirs)
+                          for f in range(args.files)]
+        self.upload = base64.b64encode(
+            os.urandom(args.file_size)).decode('ascii')
+
+    def request(self, operation, method, path, body=None):
+        started = time.perf_counter()
+        try:
+            status = self.session.request(
+                method, self.url + path,
+                data=json.dumps(body) if body is not None else None
+            ).status_code
+        except requests.RequestException:
+            status = None
+        self.samples.append((operation, time.perf_counter() - started,
+                             status))
+
+    def run(self):
+        if self.args.smoke:
+            for operation in OPERATIONS:
+                getattr(self, 'do_' + operation)()
+            return
+        while not self.stop.is_set():
+            operation = self.random.choices(self.operations,
+                                            self.weights)[0]
+            getattr(self, 'do_' + operation)()
+            if self.args.think_time:
+                time.sleep(self.random.expovariate(1 / self.args.think_time))
+
+    def do_list(self):
+        directory = '{}/dir{}'.format(self.name,
+                                      self.random.randrange(self.args.dirs))
+        self.request('list', 'GET', directory + '?content=1')
+
+    def do_open(self):
+        self.request('open', 'GET', self.random.choice(self.notebooks)
+                     + '?content=1')
+
+    def do_autosave(self):
+        self.request('autosave', 'PUT', self.random.choice(self.notebooks),
+                     {'type': 'notebook',
+                      'content': notebook(self.args.cells,
+                                          salt=' # {}'.format(time.time()))})
+
+    def do_rename(self):
+        index = self.random.randrange(len(self.notebooks))
+        old_path = self.notebooks[index]
+        new_path = '{}/dir{}/renamed-{}.ipynb'.format(
+            self.name, self.random.randrange(self.args.dirs),
+            uuid.uuid4().hex[:8])
+        self.request('rename', 'PATCH', old_path, {'path': new_path})
+        if succeeded(self.samples[-1][2]):
+            self.notebooks[index] = new_path
+
+    def do_upload(self):
+        directory = '{}/dir{}'.format(self.name,
+                                      self.random.randrange(self.args.dirs))
+        self.request('upload', 'PUT',
+                     '{}/upload-{}.bin'.format(directory,
+                                               uuid.uuid4().hex[:8]),
+                     {'type': 'file', 'format': 'base64',
+                      'content': self.upload})
+
+
+def succeeded(status):
+    return status is not None and 200 <= status < 300
+
+
+def opcounters(client):
+    return dict(client.admin.command('serverStatus')['opcounters'])
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(samples, seconds, before, after):
+    """Print the results; returns the number of failed requests per
+    operation and status (None for requests without a response)."""
+    by_operation = defaultdict(list)
+    errors = defaultdict(int)
+    failures = defaultdict(int)
+    for operation, duration, status in samples:
+        by_operation[operation].append(duration * 1000)
+        if not succeeded(status):
+            errors[operation] += 1
+            failures[operation, status] += 1
+    print('{} requests in {:.1f}s: {:.1f} requests/s'.format(
+        len(samples), seconds, len(samples) / seconds))
+    print('{:<10} {:>8} {:>7} {:>8} {:>8} {:>8} {:>8}'.format(
+        'operation', 'count', 'errors', 'p50 ms', 'p90 ms', 'p99 ms',
+        'max ms'))
+    for operation in OPERATIONS:
+        durations = sorted(by_operation.get(operation, []))
+        if not durations:
+            continue
+        print('{:<10} {:>8} {:>7} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+            operation, len(durations), errors[operation],
+            percentile(durations, 0.5), percentile(durations, 0.9),
+            percentile(durations, 0.99), durations[-1]))
+    print('mongod operations ({:.1f} per request):'.format(
+        sum(after[key] - before[key] for key in after)
+        / max(len(samples), 1)))
+    for key in sorted(after):
+        print('  {:<8} {:>10}'.format(key, after[key] - before[key]))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mongodb-uri', default='mongodb://localhost:27017')
+    parser.add_argument('--database', default='jupyter_load',
+                        help="Database to seed (must match the server's "
+                             "MongoContents.database_name with --url).")
+    parser.add_argument('--url', default=None,
+                        help="Use an already running notebook server "
+                             "(configured with MongoContents) instead of "
+                             "starting one.")
+    parser.add_argument('--token', default=None,
+                        help="Token of the server given with --url.")
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=30,
+                        help="Seconds to run the workload for.")
+    parser.add_argument('--think-time', type=float, default=0,
+                        help="Mean seconds each user waits between "
+                             "requests (0 for a closed loop).")
+    parser.add_argument('--mix', type=parse_mix, default=MIXES['default'],
+                        help="One of {} or a list of operation=weight "
+                             "pairs.".format(', '.join(sorted(MIXES))))
+    parser.add_argument('--dirs', type=int, default=5,
+                        help="Directories per user.")
+    parser.add_argument('--files', type=int, default=10,
+                        help="Notebooks (and as many text files) per "
+                             "directory.")
+    parser.add_argument('--cells', type=int, default=50,
+                        help="Cells per notebook.")
+    parser.add_argument('--file-size', type=int, default=16 * 1024,
+                        help="Size of text files and uploads in bytes.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--smoke', action='store_true',
+                        help="Make each operation once per user (ignoring "
+                             "--duration and --mix) and check that all "
+                             "succeed.")
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongodb_uri)
+    process = None
+    if args.url is None:
+        client.drop_database(args.database)
+        token = uuid.uuid4().hex
+        process, url = start_server(args, token)
+    else:
+        url, token = args.url.rstrip('/'), args.token or ''
+    users = ['loaduser{}'.format(u) for u in range(args.users)]
+    try:
+        seed(args, users)
+        stop = threading.Event()
+        threads = [User(name, args, url, token, args.mix, stop,
+                        args.seed + i)
+                   for i, name in enumerate(users)]
+        before = opcounters(client)
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        if not args.smoke:
+            time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        seconds = time.monotonic() - started
+        after = opcounters(client)
+        failures = report([sample for thread in threads
+                           for sample in thread.samples],
+                          seconds, before, after)
+        if failures:
+            sys.exit('FAILED: {}'.format(', '.join(
+                '{}: {} x {}'.format(operation, count,
+                                     status or 'no response')
+                for (operation, status), count in sorted(
+                    failures.items(), key=lambda item: str(item[0])))))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+            client.drop_database(args.database)
+
+
+if __name__ == '__main__':
+    main()
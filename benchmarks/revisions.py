@@ -0,0 +1,83 @@
+"""Benchmark delta revision storage.
+
+Saves a notebook many times with small edits, once with full and once with
+delta revision storage, and prints the bytes stored for its history and the
+time needed to read the head and to rebuild older revisions.
+
+    python benchmarks/revisions.py [--saves N] [--cells N]
+        [--keyframe-interval N]
+"""
+import argparse
+import random
+import time
+import nbformat.notebooknode
+from mongocontents import MongoContents
+
+
+def notebook(cells):
+    return nbformat.notebooknode.from_dict({
+        'metadata': {},
+        'nbformat': 4,
+        'nbformat_minor': 4,
+        'cells': [{'cell_type': 'code', 'metadata': {}, 'outputs': [],
+                   'execution_count': None, 'source': source}
+                  for source in cells],
+    })
+
+
+def timed(fn, *args, repeat=5):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def run(args, revision_storage):
+    options = {'mongodb_uri': args.mongodb_uri,
+               'database_name': args.database}
+    MongoContents(**options)._client.drop_database(args.database)
+    contents = MongoContents(revision_storage=revision_storage,
+                             keyframe_interval=args.keyframe_interval,
+                             **options)
+    rng = random.Random(0)
+    cells = ['x = {}\nprint(x * {})'.format(i, i) * 5
+             for i in range(args.cells)]
+    started = time.perf_counter()
+    for i in range(args.saves):
+        # an autosave after editing one cell
+        cells[rng.randrange(len(cells))] += '\n# edit {}'.format(i)
+        contents.save({'type': 'notebook', 'content': notebook(cells)},
+                      'benchmark.ipynb')
+    save_ms = (time.perf_counter() - started) / args.saves * 1000
+
+    revisions = contents.list_revisions('benchmark.ipynb')
+    stored = sum(revision['stored_length'] for revision in revisions)
+    logical = sum(revision['length'] for revision in revisions)
+    print('{:>5}: stored {:.2f} MB of {:.2f} MB ({:.1%}), save {:.1f} ms'
+          .format(revision_storage, stored / 1e6, logical / 1e6,
+                  stored / logical, save_ms))
+    print('       head read {:.2f} ms'.format(
+        timed(contents.get, 'benchmark.ipynb')))
+    for age in sorted({1, args.keyframe_interval // 2,
+                       args.keyframe_interval - 1, len(revisions) - 1}):
+        if 0 < age < len(revisions):
+            print('       revision -{:<3d} read {:.2f} ms'.format(
+                age, timed(contents.get_revision, 'benchmark.ipynb',
+                           revisions[age]['revision'])))
+    contents._client.drop_database(args.database)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mongodb-uri', default='mongodb://localhost:27017')
+    parser.add_argument('--database', default='jupyter_benchmark')
+    parser.add_argument('--saves', type=int, default=200)
+    parser.add_argument('--cells', type=int, default=100)
+    parser.add_argument('--keyframe-interval', type=int, default=20)
+    args = parser.parse_args()
+    for revision_storage in ['full', 'delta']:
+        run(args, revision_storage)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,574 @@
+"""Bulk import and export of directory trees.
+
+Moves whole trees between a local directory (or a tar archive) and
+MongoContents without going through save/get once per file: directories are
+inserted in batches with insert_many and file contents are uploaded and
+downloaded by a pool of worker threads. At most a fixed number of files are
+in flight at any time, so memory use is bounded by the pool size times the
+size of the largest file.
+
+Imports and exports to a directory are resumable. Imports skip files whose
+stored head is at least as new as the source, so neither files imported by an
+earlier run nor files edited since are overwritten (unless forced); exports
+skip files whose local modification time already matches the stored one.
+
+Command line usage::
+
+    python -m mongocontents.bulk import [--force] SOURCE [DEST]
+    python -m mongocontents.bulk export [--no-resume] [SOURCE] DEST
+
+where SOURCE/DEST are a local directory, a tar archive (with --tar, `-` for
+stdin/stdout) or an API path.
+"""
+import argparse
+import base64
+import datetime
+import fnmatch
+import json
+import mimetypes
+import os
+import os.path
+import re
+import sys
+import tarfile
+import time
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
+from io import BytesIO
+from typing import Callable, Iterator, List, Sequence, Set, Tuple
+from pymongo.client_session import ClientSession
+from pymongo.errors import BulkWriteError
+from .mongocontents import MongoContents
+
+# size of the reads made when streaming content to and from GridFS
+_chunk_size = 1024 * 1024
+
+# error code of a duplicate key error
+_duplicate_key = 11000
+
+
+class TransferStats:
+    """Counters reported by import_tree and export_tree."""
+
+    """files: number of files transferred"""
+    files: int
+
+    """bytes: number of bytes of file content transferred"""
+    bytes: int
+
+    """directories: number of directories created"""
+    directories: int
+
+    """skipped: number of files skipped because they were up to date"""
+    skipped: int
+
+    """seconds: wall clock duration of the transfer"""
+    seconds: float
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.directories = 0
+        self.skipped = 0
+        self.seconds = 0.0
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files / self.seconds if self.seconds else 0.0
+
+    @property
+    def mb_per_second(self) -> float:
+        return (self.bytes / 1e6 / self.seconds) if self.seconds else 0.0
+
+    def __str__(self):
+        return ("{} files ({:.1f} MB), {} directories, {} skipped in {:.2f}s: "
+                "{:.1f} files/s, {:.2f} MB/s"
+                .format(self.files, self.bytes / 1e6, self.directories,
+                        self.skipped, self.seconds, self.files_per_second,
+                        self.mb_per_second))
+
+
+class _Pool:
+    """Thread pool which never has more than window tasks in flight.
+
+    Results are handed to on_result (in the submitting thread) as tasks
+    complete; the first exception raised by a task is re-raised. The
+    sessions contents starts for the worker threads are ended on exit."""
+
+    def __init__(self, contents: MongoContents, workers: int,
+                 on_result: Callable = None):
+        self._sessions: List[ClientSession] = []
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers,
+            initializer=lambda: self._sessions.append(contents._session))
+        self._window = 2 * workers
+        self._pending: Set[Future] = set()
+        self._on_result = on_result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if exc_info[0] is None:
+                self._drain(0)
+        finally:
+            self._executor.shutdown(wait=True)
+            for session in self._sessions:
+                session.end_session()
+
+    def submit(self, fn, *args):
+        self._drain(self._window - 1)
+        self._pending.add(self._executor.submit(fn, *args))
+
+    def _drain(self, limit):
+        while len(self._pending) > limit:
+            done, self._pending = wait(self._pending,
+                                       return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if self._on_result is not None:
+                    self._on_result(result)
+
+
+def _mongo_datetime(timestamp: float) -> datetime.datetime:
+    """Convert a POSIX timestamp to the (millisecond precision, naive local)
+    datetimes stored by MongoContents."""
+    value = datetime.datetime.fromtimestamp(timestamp)
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
+
+
+def _file_model(name: str, data: bytes, mtime: float) -> Tuple[dict, str]:
+    """Build the model saved for a file, and the type to save it as."""
+    modified = _mongo_datetime(mtime)
+    model = {'created': modified, 'last_modified': modified}
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        text = None
+    if text is not None and name.endswith('.ipynb'):
+        try:
+            json.loads(text)
+        except ValueError:
+            pass
+        else:
+            model.update(content=text, format='json', mimetype=None)
+            return model, 'notebook'
+    mimetype = mimetypes.guess_type(name)[0]
+    if text is not None:
+        model.update(content=text, format='text',
+                     mimetype=mimetype or 'text/plain')
+    else:
+        model.update(content=base64.b64encode(data).decode('ascii'),
+                     format='base64',
+                     mimetype=mimetype or 'application/octet-stream')
+    return model, 'file'
+
+
+def _iter_local_tree(root: str, exclude: List[str]) \
+        -> Iterator[Tuple[str, float, Callable]]:
+    """Yield (relative path, mtime, reader) for every file under root, where
+    reader is None for directories."""
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories[:] = sorted(
+            name for name in subdirectories
+            if not any(fnmatch.fnmatch(name, p) for p in exclude))
+        relative = os.path.relpath(directory, root)
+        relative = '' if relative == '.' else relative.replace(os.sep, '/')
+        for name in subdirectories:
+            path = os.path.join(directory, name)
+            yield (relative + '/' + name).lstrip('/'), \
+                os.stat(path).st_mtime, None
+        for name in sorted(files):
+            if any(fnmatch.fnmatch(name, p) for p in exclude):
+                continue
+            path = os.path.join(directory, name)
+
+            def reader(path=path):
+                with open(path, 'rb') as f:
+                    return f.read()
+            yield (relative + '/' + name).lstrip('/'), \
+                os.stat(path).st_mtime, reader
+
+
+def _iter_tar(archive: tarfile.TarFile, exclude: List[str]) \
+        -> Iterator[Tuple[str, float, Callable]]:
+    """Like _iter_local_tree, but for a (streamed) tar archive.
+
+    The archive has to be read in order, so file content is read here rather
+    than by the workers."""
+    for member in archive:
+        name = re.sub(r'^(\./)+|^/+', '', member.name).rstrip('/')
+        if not name or any(fnmatch.fnmatch(part, p)
+                           for part in name.split('/') for p in exclude):
+            continue
+        if member.isdir():
+            yield name, member.mtime, None
+        elif member.isfile():
+            data = archive.extractfile(member).read()
+            yield name, member.mtime, (lambda data=data: data)
+
+
+class _Importer:
+    """State shared by the import workers."""
+
+    def __init__(self, contents: MongoContents, dest: str, force: bool,
+                 batch_size: int, stats: TransferStats):
+        self.contents = contents
+        self.dest = contents.normalize_path(dest.strip('/'))
+        self.force = force
+        self.batch_size = batch_size
+        self.stats = stats
+        self._seen: Set[str] = set()
+        self._directories: List[dict] = []
+
+    def path(self, relative: str) -> str:
+        return os.path.join(self.dest, relative)
+
+    def add_directory(self, path: str, mtime: float = None):
+        """Queue path (and any of its missing ancestors) for creation."""
+        while path not in self._seen:
+            self._seen.add(path)
+            modified = _mongo_datetime(mtime) if mtime is not None else None
+            self._directories.append(self.contents._directory_document(
+                path, created=modified, last_modified=modified))
+            mtime = None
+            if len(self._directories) >= self.batch_size:
+                self.flush_directories()
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
+    def flush_directories(self):
+        documents, self._directories = self._directories, []
+        if not documents:
+            return
+        try:
+            result = self.contents._directories.insert_many(
+                documents, ordered=False, session=self.contents._session)
+            inserted = len(result.inserted_ids)
+        except BulkWriteError as e:
+            errors = e.details['writeErrors']
+            if any(error['code'] != _duplicate_key for error in errors):
+                raise
+            inserted = e.details['nInserted']
+        self.stats.directories += inserted
+
+    def is_current(self, path: str, mtime: float) -> bool:
+        """Is the stored file at least as new as the source (because it was
+        imported by an earlier run, or has been edited since)?"""
+        head = self.contents._get_head(path, self.contents._heads)
+        return (head is not None
+                and head['last_modified'] >= _mongo_datetime(mtime))
+
+    def upload(self, path: str, mtime: float, reader: Callable) -> int:
+        """Upload a single file; returns the number of bytes read, or -1 if
+        the file was skipped."""
+        if not self.force and self.is_current(path, mtime):
+            return -1
+        data = reader()
+        model, file_type = _file_model(path, data, mtime)
+        self.contents._save_file(model, path, file_type=file_type)
+        return len(data)
+
+    def on_result(self, length: int):
+        if length < 0:
+            self.stats.skipped += 1
+        else:
+            self.stats.files += 1
+            self.stats.bytes += length
+
+
+def import_tree(contents: MongoContents, source: str, dest: str = '',
+                tar: bool = False, workers: int = 8, force: bool = False,
+                batch_size: int = 1000,
+                exclude: Sequence[str] = ('.ipynb_checkpoints',)) \
+        -> TransferStats:
+    """Import a local directory tree or tar archive into contents.
+
+    Parameters
+    ----------
+    contents : MongoContents
+        The contents manager to import into.
+    source : string
+        Path of the local directory, or of the tar archive if tar is True
+        (`-` reads the archive from stdin; any compression is detected).
+    dest : string
+        The API path of the directory to import into.
+    tar : bool
+        Whether source is a tar archive.
+    workers : int
+        Number of concurrent uploads.
+    force : bool
+        Overwrite every file. Otherwise files whose stored head is at least
+        as new as the source (i.e. which were imported by an earlier,
+        interrupted run, or have been edited since) are skipped.
+    batch_size : int
+        Number of directories inserted per insert_many.
+    exclude : list of strings
+        Glob patterns of file and directory names not to import.
+
+    Returns
+    -------
+    stats : TransferStats
+    """
+    stats = TransferStats()
+    started = time.monotonic()
+    importer = _Importer(contents, dest, force, batch_size, stats)
+    importer.add_directory(importer.dest)
+
+    archive = None
+    if tar:
+        archive = (tarfile.open(fileobj=sys.stdin.buffer, mode='r|*')
+                   if source == '-' else tarfile.open(source, mode='r|*'))
+        entries = _iter_tar(archive, list(exclude))
+    else:
+        entries = _iter_local_tree(source, list(exclude))
+
+    try:
+        with _Pool(contents, workers, on_result=importer.on_result) as pool:
+            for relative, mtime, reader in entries:
+                path = importer.path(relative)
+                if reader is None:
+                    importer.add_directory(path, mtime)
+                    continue
+                importer.add_directory(os.path.dirname(path))
+                pool.submit(importer.upload, path, mtime, reader)
+            importer.flush_directories()
+    finally:
+        if archive is not None:
+            archive.close()
+
+    stats.seconds = time.monotonic() - started
+    contents.log.info(f"Imported {source} into {dest or '/'}: {stats}")
+    return stats
+
+
+def _copy_content(source, target, format: str) -> int:
+    """Stream stored content to target, decoding base64 if needed. Returns
+    the number of bytes written."""
+    written = 0
+    remainder = b''
+    while True:
+        chunk = source.read(_chunk_size)
+        if not chunk:
+            break
+        if format == 'base64':
+            chunk = remainder + b''.join(chunk.split())
+            end = len(chunk) - len(chunk) % 4
+            chunk, remainder = base64.b64decode(chunk[:end]), chunk[end:]
+        target.write(chunk)
+        written += len(chunk)
+    return written
+
+
+def _iter_heads(contents: MongoContents, prefix: str) -> Iterator[dict]:
+    """Yield the head document of every live file under prefix."""
+    regex = '^' + re.escape(prefix.rstrip('/') + '/')
+    return contents._listing_heads.find(
+        {'path': {'$regex': regex},
+         **contents._descendants_shard_query(prefix),
+         'state': 'live'},
+        session=contents._session)
+
+
+class _Exporter:
+    """State shared by the export workers."""
+
+    def __init__(self, contents: MongoContents, source: str, dest: str,
+                 resume: bool, stats: TransferStats):
+        self.contents = contents
+        self.source = contents.normalize_path(source.strip('/'))
+        self.dest = dest
+        self.resume = resume
+        self.stats = stats
+
+    def relative(self, path: str) -> str:
+        return path[len(self.source.rstrip('/')):].lstrip('/')
+
+    def local_path(self, path: str) -> str:
+        return os.path.join(self.dest, *self.relative(path).split('/'))
+
+    def download(self, head: dict) -> int:
+        """Stream a single file to the local tree; returns the number of
+        bytes written, or -1 if the file was skipped (or has been deleted
+        since it was listed)."""
+        local_path = self.local_path(head['path'])
+        modified = head['last_modified'].timestamp()
+        if self.resume and os.path.exists(local_path) \
+                and int(os.stat(local_path).st_mtime * 1000) \
+                == int(modified * 1000):
+            return -1
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        partial_path = local_path + '.partial'
+
+        def write(source) -> int:
+            with open(partial_path, 'wb') as target:
+                return _copy_content(source, target, source.metadata['format'])
+
+        # the file may have been saved again since it was listed, in which
+        # case the newer head is written
+        head, length = self.contents._read_head(head['path'], head, write)
+        if head is None:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            return -1
+        modified = head['last_modified'].timestamp()
+        os.replace(partial_path, local_path)
+        os.utime(local_path, (modified, modified))
+        return length
+
+    def read(self, head: dict) -> Tuple[dict, bytes]:
+        """Read a single file into memory (for archiving); head is None if
+        the file has been deleted since it was listed."""
+
+        def read(source) -> bytes:
+            target = BytesIO()
+            _copy_content(source, target, source.metadata['format'])
+            return target.getvalue()
+
+        return self.contents._read_head(head['path'], head, read)
+
+    def on_result(self, length: int):
+        if length < 0:
+            self.stats.skipped += 1
+        else:
+            self.stats.files += 1
+            self.stats.bytes += length
+
+
+def export_tree(contents: MongoContents, source: str, dest: str,
+                tar: bool = False, workers: int = 8, resume: bool = True) \
+        -> TransferStats:
+    """Export a directory of contents to a local directory or tar archive.
+
+    Parameters
+    ----------
+    contents : MongoContents
+        The contents manager to export from.
+    source : string
+        The API path of the directory to export.
+    dest : string
+        Path of the local directory, or of the tar archive if tar is True
+        (`-` writes an uncompressed archive to stdout).
+    tar : bool
+        Whether to write a tar archive.
+    workers : int
+        Number of concurrent downloads.
+    resume : bool
+        Skip files which already exist locally with the stored modification
+        time (i.e. which were exported by an earlier, interrupted run). Has
+        no effect when writing an archive.
+
+    Returns
+    -------
+    stats : TransferStats
+    """
+    stats = TransferStats()
+    started = time.monotonic()
+    exporter = _Exporter(contents, source, dest, resume, stats)
+    regex = '^' + re.escape(exporter.source.rstrip('/') + '/')
+    directories = [directory for directory in
+                   contents._listing_directories.find(
+                       {'path': {'$regex': regex},
+                        **contents._descendants_shard_query(
+                            exporter.source)},
+                       sort=[('path', 1)],
+                       session=contents._session)
+                   if exporter.relative(directory['path'])]
+
+    if not tar:
+        os.makedirs(dest, exist_ok=True)
+        for directory in directories:
+            os.makedirs(exporter.local_path(directory['path']), exist_ok=True)
+            stats.directories += 1
+        with _Pool(contents, workers, on_result=exporter.on_result) as pool:
+            for head in _iter_heads(contents, exporter.source):
+                pool.submit(exporter.download, head)
+    else:
+        archive = (tarfile.open(fileobj=sys.stdout.buffer, mode='w|')
+                   if dest == '-' else tarfile.open(dest, mode='w'))
+
+        def add_file(result):
+            head, data = result
+            if head is None:
+                stats.skipped += 1
+                return
+            info = tarfile.TarInfo(exporter.relative(head['path']))
+            info.size = len(data)
+            info.mtime = head['last_modified'].timestamp()
+            archive.addfile(info, BytesIO(data))
+            stats.files += 1
+            stats.bytes += len(data)
+
+        try:
+            for directory in directories:
+                info = tarfile.TarInfo(exporter.relative(directory['path']))
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                info.mtime = directory['last_modified'].timestamp()
+                archive.addfile(info)
+                stats.directories += 1
+            with _Pool(contents, workers, on_result=add_file) as pool:
+                for head in _iter_heads(contents, exporter.source):
+                    pool.submit(exporter.read, head)
+        finally:
+            archive.close()
+
+    stats.seconds = time.monotonic() - started
+    contents.log.info(f"Exported {source or '/'} to {dest}: {stats}")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m mongocontents.bulk',
+        description="Bulk import/export between a local directory tree or "
+                    "tar archive and MongoDB.")
+    parser.add_argument('--mongodb-uri', default=None,
+                        help="MongoDB URI (defaults to MongoContents' "
+                             "default).")
+    parser.add_argument('--database', default=None,
+                        help="Database in which files are stored.")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="Number of concurrent uploads/downloads.")
+    parser.add_argument('--tar', action='store_true',
+                        help="Read/write a tar archive instead of a "
+                             "directory.")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    import_parser = subparsers.add_parser(
+        'import', help="Import a local directory or archive.")
+    import_parser.add_argument('source')
+    import_parser.add_argument('dest', nargs='?', default='')
+    import_parser.add_argument('--force', action='store_true',
+                               help="Overwrite every file, even if the stored "
+                                    "one is at least as new.")
+    export_parser = subparsers.add_parser(
+        'export', help="Export a directory to a local directory or archive.")
+    export_parser.add_argument('source', nargs='?', default='')
+    export_parser.add_argument('dest')
+    export_parser.add_argument('--no-resume', dest='resume',
+                               action='store_false',
+                               help="Export every file, even if it's up to "
+                                    "date.")
+    args = parser.parse_args(argv)
+
+    options = {}
+    if args.mongodb_uri is not None:
+        options['mongodb_uri'] = args.mongodb_uri
+    if args.database is not None:
+        options['database_name'] = args.database
+    contents = MongoContents(**options)
+    if args.command == 'import':
+        stats = import_tree(contents, args.source, args.dest, tar=args.tar,
+                            workers=args.workers, force=args.force)
+    else:
+        stats = export_tree(contents, args.source, args.dest, tar=args.tar,
+                            workers=args.workers, resume=args.resume)
+    print(stats, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Checkpoints of files stored by MongoContents.
+
+Every save already keeps the previous revision of a file, so a checkpoint is
+nothing but a reference to one: creating a checkpoint records the current
+head revision on the file's head document, and restoring it saves that
+revision's content as the new head. Since the reference lives on the head
+document, it follows the file through renames without any copying.
+
+Like FileCheckpoints, each file has at most one checkpoint.
+"""
+from notebook.services.contents.checkpoints import Checkpoints
+from pymongo import ReturnDocument
+from tornado import web
+
+# id of the (single) checkpoint of a file
+_checkpoint_id = 'checkpoint'
+
+
+class MongoCheckpoints(Checkpoints):
+    """Checkpoints for MongoContents, which must be the contents manager
+    they are used with (their parent)."""
+
+    @staticmethod
+    def _model(checkpoint: dict) -> dict:
+        return {'id': _checkpoint_id,
+                'last_modified': checkpoint['last_modified']}
+
+    @staticmethod
+    def _query(contents_mgr, path) -> dict:
+        """Get the query matching the head document of the live file at
+        (API) path."""
+        normal_path = contents_mgr.normalize_path(path)
+        return {'path': normal_path,
+                **contents_mgr._shard_query(normal_path),
+                'state': 'live'}
+
+    def create_checkpoint(self, contents_mgr, path):
+        """Make the current revision of the file at path its checkpoint."""
+        head = contents_mgr._heads.find_one_and_update(
+            self._query(contents_mgr, path),
+            [{'$set': {'checkpoint': {'revision': '$file_id',
+                                      'last_modified': '$last_modified'}}}],
+            projection={'checkpoint': 1},
+            return_document=ReturnDocument.AFTER,
+            session=contents_mgr._session)
+        if head is None:
+            raise web.HTTPError(404, u'No such file: {}'.format(path))
+        return self._model(head['checkpoint'])
+
+    def restore_checkpoint(self, contents_mgr, checkpoint_id, path):
+        """Save the checkpointed revision of the file at path as its new
+        head."""
+        head = contents_mgr._heads.find_one(
+            self._query(contents_mgr, path),
+            projection={'checkpoint': 1},
+            session=contents_mgr._session)
+        if (checkpoint_id != _checkpoint_id or head is None
+                or 'checkpoint' not in head):
+            raise web.HTTPError(404, u'Checkpoint does not exist: {}@{}'
+                                .format(path, checkpoint_id))
+        model = contents_mgr.get_revision(
+            path, str(head['checkpoint']['revision']))
+        contents_mgr.save({key: model[key] for key
+                           in ['type', 'format', 'mimetype', 'content']},
+                          path)
+
+    def rename_checkpoint(self, checkpoint_id, old_path, new_path):
+        """Nothing to do: the checkpoint has moved along with the head
+        document."""
+
+    def delete_checkpoint(self, checkpoint_id, path):
+        contents_mgr = self.parent
+        result = None
+        if checkpoint_id == _checkpoint_id:
+            result = contents_mgr._heads.update_one(
+                {**self._query(contents_mgr, path),
+                 'checkpoint': {'$exists': True}},
+                {'$unset': {'checkpoint': ''}},
+                session=contents_mgr._session)
+        if result is None or result.matched_count == 0:
+            raise web.HTTPError(404, u'Checkpoint does not exist: {}@{}'
+                                .format(path, checkpoint_id))
+
+    def list_checkpoints(self, path):
+        contents_mgr = self.parent
+        head = contents_mgr._heads.find_one(
+            self._query(contents_mgr, path),
+            projection={'checkpoint': 1},
+            session=contents_mgr._session)
+        if head is None or 'checkpoint' not in head:
+            return []
+        return [self._model(head['checkpoint'])]
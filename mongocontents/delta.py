@@ -0,0 +1,46 @@
+"""Deltas between revisions of text files and notebooks.
+
+Content is split into tokens ending at each newline or ", " (notebooks are
+stored as single-line JSON, so splitting on lines alone would not find any
+common content). A delta is a JSON list of operations which, applied in order,
+rebuild the target from the base:
+
+- [start, end]: copy tokens start to end (exclusive) of the base
+- "text": insert text
+"""
+import difflib
+import json
+import re
+from typing import List
+
+
+def _tokens(data: bytes) -> List[str]:
+    return re.findall(r'.*?(?:\n|, )|.+', data.decode(), re.S)
+
+
+def diff(base: bytes, target: bytes) -> bytes:
+    """Compute the delta which turns base into target."""
+    base_tokens = _tokens(base)
+    target_tokens = _tokens(target)
+    matcher = difflib.SequenceMatcher(None, base_tokens, target_tokens)
+    operations = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            operations.append([i1, i2])
+        elif j2 > j1:
+            # replace and insert; deletions just skip base tokens
+            operations.append(''.join(target_tokens[j1:j2]))
+    return json.dumps(operations, separators=(',', ':')).encode()
+
+
+def patch(base: bytes, delta: bytes) -> bytes:
+    """Apply a delta computed by diff to base."""
+    base_tokens = _tokens(base)
+    result = []
+    for operation in json.loads(delta.decode()):
+        if isinstance(operation, str):
+            result.append(operation)
+        else:
+            start, end = operation
+            result.extend(base_tokens[start:end])
+    return ''.join(result).encode()
@@ -0,0 +1,38 @@
+"""Migrate a database written by an older version of MongoContents.
+
+Older versions did not track the head (current revision) of each file;
+MongoContents refuses to start on such a database until it has been migrated
+(see MongoContents.migrate_heads). The migration is resumable, so it can
+simply be run again if it is interrupted.
+
+Command line usage::
+
+    python -m mongocontents.migrate [--mongodb-uri URI] [--database NAME]
+"""
+import argparse
+from .mongocontents import MongoContents
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m mongocontents.migrate',
+        description="Migrate files stored by older versions of "
+                    "MongoContents.")
+    parser.add_argument('--mongodb-uri', default=None,
+                        help="MongoDB URI (defaults to MongoContents' "
+                             "default).")
+    parser.add_argument('--database', default=None,
+                        help="Database in which files are stored.")
+    args = parser.parse_args(argv)
+
+    options = {}
+    if args.mongodb_uri is not None:
+        options['mongodb_uri'] = args.mongodb_uri
+    if args.database is not None:
+        options['database_name'] = args.database
+    # migrate_on_start runs the migration instead of refusing to start
+    MongoContents(migrate_on_start=True, **options)
+
+
+if __name__ == '__main__':
+    main()
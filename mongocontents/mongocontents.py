@@ -1,24 +1,55 @@
 import datetime
+import hashlib
 import json
 import os.path
 import re
-from typing import List, Union
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, List, Tuple, Union
 import nbformat
 import notebook.transutils
 from notebook.services.contents.manager import ContentsManager
 from tornado import web
-from traitlets import Unicode
+from traitlets import Bool, Dict, Enum, Integer, Unicode, default
 from pymongo import MongoClient
+from pymongo.client_session import ClientSession
 from pymongo.collection import Collection as MongoCollection
 from pymongo.database import Database as MongoDatabase
-from pymongo.errors import DuplicateKeyError
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.read_preferences import (Nearest, Primary, PrimaryPreferred,
+                                      Secondary, SecondaryPreferred)
+from bson import ObjectId
+from bson.errors import InvalidId
 from gridfs import GridFSBucket
-from gridfs.grid_file import GridIn, GridOutCursor, GridOut
+from gridfs.errors import CorruptGridFile, NoFile
+from gridfs.grid_file import GridIn, GridOut
+from .checkpoints import MongoCheckpoints
+from .delta import diff, patch
 
 # see http://jupyter-notebook.readthedocs.io/en/latest/extending/contents.html
 # for a high-level overview of entity types (much of the documentation below
 # is based on, or copied verbatim from, this source)
 
+# map of read preference mode names (as used in MongoDB connection strings) to
+# the read preference objects understood by pymongo
+_read_preferences = {
+    'primary': Primary(),
+    'primaryPreferred': PrimaryPreferred(),
+    'secondary': Secondary(),
+    'secondaryPreferred': SecondaryPreferred(),
+    'nearest': Nearest(),
+}
+
+# error code of a duplicate key error
+_duplicate_key = 11000
+
+# version of the layout of stored files, recorded in the metadata of every
+# GridFS file; files without it were stored before heads were tracked and
+# need to be migrated (see MongoContents.migrate_heads)
+_schema_version = 2
+
 
 class MongoContents(ContentsManager):
 
@@ -44,12 +75,91 @@ class MongoContents(ContentsManager):
         config=True,
         help="Collection in which file metadata is stored.")
 
+    heads_collection_name: str = Unicode(
+        'heads',
+        config=True,
+        help="Collection holding the head (current revision) of every file, "
+             "including deleted files until they are purged from the trash.")
+
+    migrate_on_start: bool = Bool(
+        False,
+        config=True,
+        help="Migrate files stored by older versions (see migrate_heads) when "
+             "starting, instead of refusing to start.")
+
+    trash_retention_days: int = Integer(
+        30,
+        config=True,
+        help="Number of days deleted files are kept in the trash (and can be "
+             "restored) before purge_trash removes them.")
+
+    usage_collection_name: str = Unicode(
+        'usage',
+        config=True,
+        help="Collection in which per-directory storage usage is stored.")
+
+    quotas: dict = Dict(
+        config=True,
+        help="Storage quotas, as a map of directory path to the maximum "
+             "number of bytes (including every stored revision) that may be "
+             "stored under that directory, e.g. {'alice': 1073741824}.")
+
     path_prefix: str = Unicode(
         '/',
         config=True,
         help="Prefix at which to serve files."
     )
 
+    listing_read_preference: str = Enum(
+        list(_read_preferences.keys()),
+        default_value='primary',
+        config=True,
+        help="Read preference used for directory listings (the subdirectory "
+             "query and the file aggregation in get with content=True).")
+
+    metadata_read_preference: str = Enum(
+        list(_read_preferences.keys()),
+        default_value='primary',
+        config=True,
+        help="Read preference used for metadata lookups (existence checks "
+             "and models fetched with content=False).")
+
+    content_read_preference: str = Enum(
+        list(_read_preferences.keys()),
+        default_value='primary',
+        config=True,
+        help="Read preference used when reading file and notebook content "
+             "out of GridFS.")
+
+    revision_storage: str = Enum(
+        ['full', 'delta'],
+        default_value='full',
+        config=True,
+        help="How revisions of text files and notebooks are stored. 'full' "
+             "keeps every revision as is; 'delta' replaces each superseded "
+             "revision by a delta against its successor, except for every "
+             "keyframe_interval'th revision. The head is always stored in "
+             "full.")
+
+    keyframe_interval: int = Integer(
+        10,
+        config=True,
+        help="In delta revision storage, every keyframe_interval'th revision "
+             "is kept in full, which bounds the number of deltas applied to "
+             "rebuild an old revision.")
+
+    shard_key_depth: int = Integer(
+        0,
+        config=True,
+        help="Number of leading path components (e.g. 1 for /<owner>/..., 2 "
+             "for /<owner>/<project>/...) hashed into the shard key of "
+             "every directory and file. 0 disables sharding mode. See "
+             "mongocontents.sharding for setting up a sharded cluster.")
+
+    @default('checkpoints_class')
+    def _checkpoints_class_default(self):
+        return MongoCheckpoints
+
     _client: MongoClient
     _database: MongoDatabase
     _directories: MongoCollection
@@ -68,11 +178,131 @@ class MongoContents(ContentsManager):
             = GridFSBucket(self._database, self.files_collection_name)
         self._files_metadata: MongoCollection\
             = self._database[self.files_collection_name].files
-
-        self._directories.create_index('path', unique=True)
+        self._usage: MongoCollection\
+            = self._database[self.usage_collection_name]
+        self._heads: MongoCollection\
+            = self._database[self.heads_collection_name]
+
+        # reads are routed per operation class; writes always go through the
+        # collections above (which use the client's default, the primary)
+        listing_database = self._database.with_options(
+            read_preference=_read_preferences[self.listing_read_preference])
+        metadata_database = self._database.with_options(
+            read_preference=_read_preferences[self.metadata_read_preference])
+        content_database = self._database.with_options(
+            read_preference=_read_preferences[self.content_read_preference])
+        self._listing_directories: MongoCollection\
+            = listing_database[self.directories_collection_name]
+        self._listing_heads: MongoCollection\
+            = listing_database[self.heads_collection_name]
+        self._metadata_directories: MongoCollection\
+            = metadata_database[self.directories_collection_name]
+        self._metadata_heads: MongoCollection\
+            = metadata_database[self.heads_collection_name]
+        self._content_files: GridFSBucket\
+            = GridFSBucket(content_database, self.files_collection_name)
+        # sessions may not be shared between threads, so every thread that
+        # talks to mongod through this instance gets its own
+        self._sessions = threading.local()
+
+        self.create_indices()
+        # one indexed lookup: files without a schema version predate heads
+        if self._files_metadata.find_one({'metadata.schema': None},
+                                         projection={'_id': 1},
+                                         session=self._session) is not None:
+            if not self.migrate_on_start:
+                raise RuntimeError(
+                    "Database {} holds files stored by an older version of "
+                    "MongoContents. Migrate them by running `python -m "
+                    "mongocontents.migrate` or by setting "
+                    "MongoContents.migrate_on_start = True."
+                    .format(self.database_name))
+            migrated = self.migrate_heads()
+            self.log.info(f"Migrated {migrated} files to tracked heads")
         if not self.dir_exists('/'):
             self.save({'type': 'directory'}, '/')
 
+    def create_indices(self):
+        """Create the indexes MongoContents relies on.
+
+        In sharding mode every index is prefixed with the shard key, as
+        required for the unique indexes on paths.
+
+        Heads of live files and of deleted files are kept apart by partial
+        indexes, so lookups of live files never touch the trash. The one on
+        live paths is unique, which is what keeps a path from ever having two
+        heads."""
+        shard = [('shard', 1)] if self.shard_key_depth else []
+        self._directories.create_index(shard + [('path', 1)], unique=True)
+        self._heads.create_index(
+            shard + [('path', 1)],
+            name='live_' + '_'.join(key for key, _ in shard + [('path', 1)]),
+            unique=True,
+            partialFilterExpression={'state': 'live'})
+        self._heads.create_index(
+            shard + [('path', 1), ('deleted_at', -1)],
+            partialFilterExpression={'state': 'trash'})
+        self._heads.create_index(
+            'deleted_at', partialFilterExpression={'state': 'trash'})
+        # finds files which need to be migrated (missing values are indexed
+        # as null)
+        self._files_metadata.create_index('metadata.schema')
+        # finds the revisions of a file, wherever they were stored
+        self._files_metadata.create_index([('metadata.file', 1),
+                                           ('uploadDate', -1)])
+        if self.shard_key_depth:
+            # backs the shard key, which a partial index cannot
+            self._heads.create_index(shard + [('path', 1), ('state', 1)])
+            # backs the files shard key and lookups of revisions (GridFS
+            # itself only indexes filename and uploadDate)
+            self._files_metadata.create_index([('metadata.shard', 1),
+                                               ('filename', 1),
+                                               ('uploadDate', -1)])
+
+    def _shard(self, path) -> Union[str, None]:
+        """Get the shard key value of a (normalized) path.
+
+        This is a hash of the first shard_key_depth components of the path,
+        so that each owner/project lives on a single shard while different
+        ones are spread evenly across shards."""
+        if not self.shard_key_depth:
+            return None
+        components = [component for component
+                      in self.denormalize_path(path).split('/') if component]
+        prefix = '/'.join(components[:self.shard_key_depth])
+        return hashlib.md5(prefix.encode()).hexdigest()[:16]
+
+    def _shard_query(self, path, field='shard') -> dict:
+        """Get the query fragment which targets the shard holding path."""
+        if not self.shard_key_depth:
+            return {}
+        return {field: self._shard(path)}
+
+    def _descendants_shard_query(self, path, field='shard') -> dict:
+        """Get the query fragment which targets the shard holding every
+        descendant of path.
+
+        This is only possible when path is at least shard_key_depth deep;
+        above that, queries have to be broadcast to every shard."""
+        components = [component for component
+                      in self.denormalize_path(path).split('/') if component]
+        if len(components) < self.shard_key_depth:
+            return {}
+        return self._shard_query(os.path.join(path, '_'), field)
+
+    @property
+    def _session(self) -> ClientSession:
+        """Causally consistent session for the calling thread.
+
+        All reads and writes are issued in this session so that reads routed
+        to secondaries still observe the writes made by save, rename_file and
+        delete_file on this instance."""
+        session = getattr(self._sessions, 'session', None)
+        if session is None:
+            session = self._client.start_session(causal_consistency=True)
+            self._sessions.session = session
+        return session
+
     def normalize_path(self, path):
         return os.path.join(self.path_prefix, path)
 
@@ -97,9 +327,10 @@ class MongoContents(ContentsManager):
         return self._dir_exists(self.normalize_path(path))
 
     def _dir_exists(self, path):
-        result = self._directories.find_one({
-            'path': path
-        })
+        result = self._metadata_directories.find_one({
+            'path': path,
+            **self._shard_query(path),
+        }, session=self._session)
         if result is None:
             return False
         else:
@@ -127,48 +358,66 @@ class MongoContents(ContentsManager):
         return (basename.startswith('.')
                 or basename.startswith('__'))
 
-    def _get_file_gridout(self, path, ignore_deleted=True) \
-            -> Union[GridOut, None]:
-        """Get the GridOut object associated with the file.
-
-        If a deleted file is found and ignore_deleted is True, None will be
-        returned.
-        """
-        cursor: GridOutCursor
-        cursor = (self._files
-                  .find({'filename': path})
-                  .sort('uploadDate', -1)
-                  .limit(1))
-        if cursor.count() == 0:
-            return None
-        file: GridOut = list(cursor)[0]
-        metadata: dict = file.metadata
-        if (ignore_deleted and 'deleted' in metadata
-                and metadata['deleted'] is True):
-            return None
-        return file
-
-    def _update_file_metadata(self, path_: str, filename=None, **kwargs):
-        """Update file metadata.
-
-        update should be a dict of {key: new-value} pairs in the metadata, with
-        the exception of the filename key, which updates the filename of the
-        GridFS file (not in file.metadata)."""
-        # path is a metadata key too and we don't want to accidentally pass it
-        # twice as an argument to the function if we're trying to rename a file
-        path = path_
-        # map keys to metadata keys
-        update = {'$set': {('metadata.' + key): kwargs[key]
-                           for key in kwargs.keys()}}
-        # special case for filename
-        if filename is not None:
-            update['$set']['filename'] = filename
-        result = self._files_metadata.find_one_and_update(
-            filter={'filename': path},
-            update=update,
-            sort=[('uploadDate', -1)])
-        if result is None:
-            raise FileNotFoundError
+    def _get_head(self, path, collection: MongoCollection = None) \
+            -> Union[dict, None]:
+        """Get the head document of the live file at path, or None.
+
+        The head document points at the current revision (file_id) and
+        carries everything needed to build a model without content. It is
+        read from the metadata read preference unless another collection is
+        given."""
+        collection = (self._metadata_heads if collection is None
+                      else collection)
+        return collection.find_one({'path': path,
+                                    **self._shard_query(path),
+                                    'state': 'live'},
+                                   session=self._session)
+
+    def _open_revision(self, path, file_id) -> GridOut:
+        """Open a revision of the file at path for reading, with the content
+        read preference.
+
+        The revision is looked up by path as well as id, so that in sharding
+        mode it is read from a single shard; one which has not (yet) followed
+        a rename is found by id alone."""
+        queries = [{'_id': file_id}]
+        if self.shard_key_depth:
+            queries.insert(0, {'_id': file_id, 'filename': path,
+                               **self._shard_query(path, 'metadata.shard')})
+        for query in queries:
+            for file in self._content_files.find(
+                    query, session=self._session).limit(1):
+                return file
+        raise NoFile('no revision {} of {}'.format(file_id, path))
+
+    def _read_head(self, path, head: dict, read: Callable = None) -> Tuple:
+        """Read the head revision of the file at path, as last looked up in
+        head.
+
+        read is called with the opened revision and defaults to reading all
+        of it. A concurrent save may turn the revision into a delta, removing
+        its chunks, at any time; the head is then looked up again (it points
+        at the newer revision by then) and read from the start. Returns the
+        head actually read along with the result of read, or (None, None) if
+        the file has been deleted meanwhile."""
+        if read is None:
+            read = lambda file: file.read()
+        while head is not None:
+            file = self._open_revision(path, head['file_id'])
+            if file.metadata.get('storage') != 'delta':
+                try:
+                    return head, read(file)
+                except CorruptGridFile:
+                    # its chunks were removed while we read them, which is
+                    # only expected if it has become a delta
+                    if self._files_metadata.find_one(
+                            {'_id': head['file_id'],
+                             'metadata.storage': 'delta'},
+                            projection={'_id': 1},
+                            session=self._session) is None:
+                        raise
+            head = self._get_head(path, self._heads)
+        return None, None
 
     def file_exists(self, path: str = '') -> bool:
         """Does a file exist at the given path?
@@ -189,7 +438,7 @@ class MongoContents(ContentsManager):
 
     def _file_exists(self, path: str) -> bool:
         """Like file_exists but expects normalized path."""
-        return self._get_file_gridout(path) is not None
+        return self._get_head(path) is not None
 
     def get(self, path, content=True, type=None, format=None) -> dict:
         """Get a file or directory model.
@@ -252,7 +501,8 @@ class MongoContents(ContentsManager):
         """Get a dictionary model or none.
 
         See the get method for parameter and return type details."""
-        data = self._directories.find_one({'path': path})
+        data = self._metadata_directories.find_one(
+            {'path': path, **self._shard_query(path)}, session=self._session)
         if data is None:
             return None
 
@@ -279,10 +529,11 @@ class MongoContents(ContentsManager):
         # match_regex: regex to match exactly one level past the path
         match_regex = '^' + re.escape(path.rstrip('/') + '/') + r'[^\/]+$'
 
-        subdirectories = self._directories.find(
-            {'path': {'$regex': match_regex}})
+        subdirectories = self._listing_directories.find(
+            {'path': {'$regex': match_regex},
+             **self._descendants_shard_query(path)},
+            session=self._session)
         for subdirectory in subdirectories:
-            print(subdirectory['path'])
             children.append({
                 'name': os.path.basename(subdirectory['path']),
                 'path': self.denormalize_path(subdirectory['path']),
@@ -294,39 +545,22 @@ class MongoContents(ContentsManager):
                 'content': None,
             })
 
-        # description of pipeline:
-        # $match: is pretty obvious
-        # $sort: sorts individual files by their uploadedDate (newest first)
-        # $group: groups documents together
-        #   - _id: $filename groups by filename
-        #   - item is the directory or file in the returned document ($first:
-        #     specifies that we want the first matching document (i.e. newest)
-        #     and $$ROOT means that we want the entire document
-        # $project: we only care about the file we found in the grouping stage
-        pipeline = [
-            {'$match': {'filename': {'$regex': match_regex}}},
-            {'$sort': {'uploadedDate': -1}},
-            {'$group': {'_id': '$filename', 'file': {'$first': '$$ROOT'}}},
-            {'$project': {'file': 1, '_id': 0}},
-        ]
-        files_cursor = self._files_metadata.aggregate(pipeline)
-        for document in files_cursor:
-            # note: since file is a document, not a GridOut, we can't use
-            # .attribute, we have to use ['attribute']
-            file = document['file']
-            metadata = file['metadata']
-            print(file['filename'])
-            if ('deleted' in metadata
-                    and metadata['deleted'] is True):
-                continue
+        # only live files are in the partial index, so this never looks at
+        # deleted files
+        heads = self._listing_heads.find(
+            {'path': {'$regex': match_regex},
+             **self._descendants_shard_query(path),
+             'state': 'live'},
+            session=self._session)
+        for head in heads:
             children.append({
-                'name': os.path.basename(file['filename']),
-                'path': self.denormalize_path(file['filename']),
-                'type': metadata['type'],
-                'created': metadata['created'],
-                'last_modified': metadata['last_modified'],
-                'mimetype': metadata['mimetype'],
-                'format': metadata['format'],
+                'name': os.path.basename(head['path']),
+                'path': self.denormalize_path(head['path']),
+                'type': head['type'],
+                'created': head['created'],
+                'last_modified': head['last_modified'],
+                'mimetype': head['mimetype'],
+                'format': head['format'],
                 'content': None,
             })
         children.sort(key=lambda i: i['name'])
@@ -335,50 +569,65 @@ class MongoContents(ContentsManager):
         return model
 
     def _get_file(self, path, content=True) -> Union[dict, None]:
-        file: GridOut = self._get_file_gridout(path)
-        metadata: dict = file.metadata
+        head = self._get_head(path)
+        if head is None:
+            return None
 
         # if type wasn't specified as a parameter to self.get, we tend to
         # initially guess that notebooks are files, so we have to change courses
         # if that happens
-        if metadata['type'] == 'notebook':
-            return self._get_notebook(path, content, file=file)
+        if head['type'] == 'notebook':
+            return self._get_notebook(path, content, head=head)
+
+        data = None
+        if content:
+            head, data = self._read_head(path, head)
+            if head is None:
+                return None
 
         model = {
-            'name': os.path.basename(metadata['path']),
-            'path': self.denormalize_path(metadata['path']),
-            'format': metadata['format'],
-            'mimetype': metadata['mimetype'],
-            'type': metadata['type'],
-            'created': metadata['created'],
-            'last_modified': metadata['last_modified'],
+            'name': os.path.basename(head['path']),
+            'path': self.denormalize_path(head['path']),
+            'format': None,
+            'mimetype': head['mimetype'],
+            'type': head['type'],
+            'created': head['created'],
+            'last_modified': head['last_modified'],
+            'revision': str(head['file_id']),
             'writable': True,
             'content': None,
         }
         if not content:
             return model
 
-        model['content'] = file.read().decode()
+        model['format'] = head['format']
+        model['content'] = data.decode()
         return model
 
-    def _get_notebook(self, path: str, content: bool, file: GridOut = None) \
+    def _get_notebook(self, path: str, content: bool, head: dict = None) \
             -> Union[dict, None]:
         """Get a dictionary model or None.
 
         See the get method for parameter and return type details."""
-        print('get notebook')
-        file: GridOut = self._get_file_gridout(path) if file is None else file
-        metadata: dict = file.metadata
+        head = self._get_head(path) if head is None else head
+        if head is None:
+            return None
+        data = None
+        if content:
+            head, data = self._read_head(path, head)
+            if head is None:
+                return None
 
         model = {
-            'name': metadata['name'],
-            'path': self.denormalize_path(metadata['path']),
+            'name': head['name'],
+            'path': self.denormalize_path(head['path']),
             'format': None,
             'content': None,
-            'mimetype': metadata['mimetype'],
-            'type': metadata['type'],
-            'created': metadata['created'],
-            'last_modified': metadata['last_modified'],
+            'mimetype': head['mimetype'],
+            'type': head['type'],
+            'created': head['created'],
+            'last_modified': head['last_modified'],
+            'revision': str(head['file_id']),
             'writable': True,
         }
         if not content:
@@ -387,7 +636,7 @@ class MongoContents(ContentsManager):
             return model
 
         model['format'] = 'json'
-        model['content'] = nbformat.notebooknode.from_dict(json.load(file))
+        model['content'] = nbformat.notebooknode.from_dict(json.loads(data))
         self.log.debug(
             f"Returning model at {path} with content: {model}")
         return model
@@ -396,17 +645,343 @@ class MongoContents(ContentsManager):
         self._delete_file(self.normalize_path(path))
 
     def _delete_file(self, path):
-        self._update_file_metadata(path, deleted=True)
+        """Move the file at path to the trash.
+
+        This is a single update of the file's head document, which leaves the
+        partial index of live files and enters that of the trash at once; the
+        file can be restored from there until it is purged."""
+        result = self._heads.update_one(
+            {'path': path, **self._shard_query(path), 'state': 'live'},
+            {'$set': {'state': 'trash',
+                      'deleted_at': datetime.datetime.now()}},
+            session=self._session)
+        if result.matched_count == 0:
+            raise FileNotFoundError
+
+    def list_trash(self, path='') -> List[dict]:
+        """List the deleted files under a directory, newest first.
+
+        Parameters
+        ----------
+        path : string
+            The API path of the directory.
+
+        Returns
+        -------
+        files : list of dicts
+            - name (unicode)
+                basename of the deleted file
+            - path (unicode)
+                API path the file was deleted from
+            - type (unicode)
+                "file" or "notebook"
+            - deleted_at (datetime)
+                when the file was deleted
+            - purge_after (datetime)
+                when the file becomes eligible for purging
+        """
+        normal_path = self.normalize_path(path)
+        regex = '^' + re.escape(normal_path.rstrip('/') + '/')
+        entries = self._heads.find(
+            {'path': {'$regex': regex},
+             **self._descendants_shard_query(normal_path),
+             'state': 'trash'},
+            sort=[('deleted_at', -1)],
+            session=self._session)
+        retention = datetime.timedelta(days=self.trash_retention_days)
+        return [{
+            'name': os.path.basename(entry['path']),
+            'path': self.denormalize_path(entry['path']),
+            'type': entry['type'],
+            'deleted_at': entry['deleted_at'],
+            'purge_after': entry['deleted_at'] + retention,
+        } for entry in entries]
+
+    def restore_file(self, path):
+        """Restore the most recently deleted file at path from the trash.
+
+        Raises a 404 HTTPError if there is nothing to restore, and a 409 if a
+        file has since been created at path. Returns the restored model
+        without content."""
+        normal_path = self.normalize_path(path)
+        query = {'path': normal_path, **self._shard_query(normal_path),
+                 'state': 'trash'}
+        entry = self._heads.find_one(query, sort=[('deleted_at', -1)],
+                                     session=self._session)
+        if entry is None:
+            raise web.HTTPError(404, u'No deleted file at {}'.format(path))
+        try:
+            result = self._heads.update_one(
+                {**query, '_id': entry['_id']},
+                {'$set': {'state': 'live'}, '$unset': {'deleted_at': ''}},
+                session=self._session)
+        except DuplicateKeyError:
+            # the unique index on live paths
+            raise web.HTTPError(409, u'File {} already exists'.format(path))
+        if result.matched_count == 0:
+            raise web.HTTPError(404, u'No deleted file at {}'.format(path))
+        return self.get(path, content=False)
+
+    def purge_trash(self, batch_size=100, older_than=None) -> int:
+        """Permanently remove files deleted more than trash_retention_days
+        ago (or before older_than, if given), along with their revisions.
+
+        Trash entries are processed batch_size at a time, each batch removing
+        the GridFS files and chunks with one delete_many each. Revisions are
+        found by the file they belong to (see _save_file), so those stored
+        under an earlier name are purged too, while a file created at the
+        same path since keeps its own. Returns the number of trash entries
+        purged."""
+        if older_than is None:
+            older_than = (datetime.datetime.now()
+                          - datetime.timedelta(days=self.trash_retention_days))
+        return self._purge_trash({'state': 'trash',
+                                  'deleted_at': {'$lt': older_than}},
+                                 batch_size)
+
+    def empty_trash(self, path='', batch_size=100) -> int:
+        """Permanently remove every deleted file under a directory right
+        away, along with its revisions.
+
+        This frees the space they count against quotas without waiting for
+        purge_trash. Returns the number of trash entries removed."""
+        normal_path = self.normalize_path(path)
+        regex = '^' + re.escape(normal_path.rstrip('/') + '/')
+        return self._purge_trash({'path': {'$regex': regex},
+                                  **self._descendants_shard_query(normal_path),
+                                  'state': 'trash'},
+                                 batch_size)
+
+    def _purge_trash(self, query: dict, batch_size: int) -> int:
+        """Purge the trash entries matching query, oldest first and
+        batch_size at a time."""
+        purged = 0
+        while True:
+            entries = list(self._heads.find(
+                query,
+                projection={'_id': 1},
+                sort=[('deleted_at', 1)],
+                limit=batch_size,
+                session=self._session))
+            if not entries:
+                return purged
+            keys = [entry['_id'] for entry in entries]
+            self._remove_revisions(list(self._files_metadata.find(
+                {'metadata.file': {'$in': keys}},
+                projection={'filename': 1, 'length': 1},
+                session=self._session)))
+            self._heads.delete_many({'_id': {'$in': keys}, 'state': 'trash'},
+                                    session=self._session)
+            purged += len(entries)
+
+    def prune_revisions(self, path, keep=1) -> int:
+        """Permanently remove all but the newest keep revisions of a file.
+
+        The head is always kept, and so is the file's checkpoint, if any.
+        Since a revision stored as a delta needs its successor, every
+        revision newer than one that is kept is kept too. This frees the
+        space the removed revisions count against quotas. Returns the number
+        of revisions removed."""
+        normal_path = self.normalize_path(path)
+        head = self._heads.find_one(
+            {'path': normal_path, **self._shard_query(normal_path),
+             'state': 'live'},
+            projection={'file_id': 1, 'checkpoint': 1},
+            session=self._session)
+        if head is None:
+            raise web.HTTPError(404, u'No such file: {}'.format(path))
+        revisions = list(self._files_metadata.find(
+            {'metadata.file': head['_id'],
+             'metadata.delta_of': {'$exists': False}},
+            projection={'_id': 1},
+            sort=[('uploadDate', -1)],
+            session=self._session))
+        required = {head['file_id']}
+        if 'checkpoint' in head:
+            required.add(head['checkpoint']['revision'])
+        oldest_kept = max([keep - 1] + [i for i, revision
+                                        in enumerate(revisions)
+                                        if revision['_id'] in required])
+        pruned = [revision['_id'] for revision in revisions[oldest_kept + 1:]]
+        if not pruned:
+            return 0
+        # with the deltas stored for them
+        self._remove_revisions(list(self._files_metadata.find(
+            {'$or': [{'_id': {'$in': pruned}},
+                     {'metadata.delta_of': {'$in': pruned}}]},
+            projection={'filename': 1, 'length': 1},
+            session=self._session)))
+        return len(pruned)
+
+    def _remove_revisions(self, revisions: List[dict]):
+        """Remove the given GridFS files (documents with _id, filename and
+        length) and their chunks.
+
+        Usage counters are only adjusted once they are gone, so they never
+        count less than is stored; revisions stored under earlier names of a
+        file count against the directories they were stored in."""
+        file_ids = [revision['_id'] for revision in revisions]
+        if not file_ids:
+            return
+        self._files_metadata.delete_many({'_id': {'$in': file_ids}},
+                                         session=self._session)
+        self._database[self.files_collection_name].chunks.delete_many(
+            {'files_id': {'$in': file_ids}}, session=self._session)
+        totals = defaultdict(lambda: [0, 0])
+        for revision in revisions:
+            totals[revision['filename']][0] += revision['length']
+            totals[revision['filename']][1] += 1
+        for filename, (length, count) in totals.items():
+            self._adjust_usage(self._ancestors(filename), -length, -count)
+
+    def _head_fields(self, file_id, metadata: dict, length: int) -> dict:
+        """Get the fields of a head document which describe its revision."""
+        return {
+            'file_id': file_id,
+            'name': metadata['name'],
+            'type': metadata['type'],
+            'last_modified': metadata['last_modified'],
+            'mimetype': metadata.get('mimetype'),
+            'format': metadata.get('format'),
+            'length': length,
+        }
+
+    def migrate_heads(self, batch_size=1000) -> int:
+        """Create the head documents of files stored before heads were
+        tracked, putting deleted ones in the trash.
+
+        The newest revision of each file becomes its head. Needs to be run
+        once on databases created by older versions (MongoContents refuses to
+        start on them unless migrate_on_start is set; see also
+        `python -m mongocontents.migrate`). Revisions are stamped with the
+        current schema version once the head of their file has been written,
+        so an interrupted migration picks up where it left off. Returns the
+        number of files migrated."""
+        pipeline = [
+            {'$match': {'metadata.schema': None}},
+            {'$sort': {'filename': 1, 'uploadDate': -1}},
+            {'$group': {'_id': '$filename', 'file': {'$first': '$$ROOT'}}},
+            {'$replaceRoot': {'newRoot': '$file'}},
+            {'$project': {'filename': 1, 'metadata': 1, 'length': 1}},
+        ]
+        cursor = self._files_metadata.aggregate(
+            pipeline, allowDiskUse=True, session=self._session)
+        now = datetime.datetime.now()
+        migrated = 0
+        requests = []
+        files = []
+        for file in cursor:
+            path = file['filename']
+            metadata = file['metadata']
+            head = self._head_fields(file['_id'], metadata, file['length'])
+            head.update(created=metadata['created'], revision_number=1)
+            file_id = head.pop('file_id')
+            if metadata.get('deleted', False):
+                head.update(state='trash', deleted_at=now)
+            else:
+                head['state'] = 'live'
+            requests.append(UpdateOne(
+                {'path': path, **self._shard_query(path),
+                 'file_id': file_id},
+                {'$setOnInsert': head},
+                upsert=True))
+            files.append((path, file_id))
+            if len(requests) >= batch_size:
+                self._migrate_batch(requests, files)
+                migrated += len(requests)
+                requests = []
+                files = []
+        if requests:
+            self._migrate_batch(requests, files)
+            migrated += len(requests)
+        return migrated
+
+    def _migrate_batch(self, requests: List[UpdateOne], files: list):
+        """Write a batch of head upserts made by migrate_heads and stamp the
+        revisions of their files (a list of (path, head revision id)).
+
+        Files which have been given a (different) live head since are
+        skipped; their old revisions are attributed to that head."""
+        try:
+            self._heads.bulk_write(requests, ordered=False,
+                                   session=self._session)
+        except BulkWriteError as e:
+            if any(error['code'] != _duplicate_key
+                   for error in e.details['writeErrors']):
+                raise
+        heads = self._heads.find(
+            {'path': {'$in': [path for path, _ in files]}},
+            projection={'path': 1, 'file_id': 1, 'state': 1},
+            session=self._session)
+        by_revision = {}
+        live = {}
+        for head in heads:
+            by_revision[head['file_id']] = head['_id']
+            if head['state'] == 'live':
+                live[head['path']] = head['_id']
+        stamps = []
+        for path, file_id in files:
+            key = by_revision.get(file_id, live.get(path))
+            stamp = {'metadata.schema': _schema_version}
+            if key is not None:
+                stamp['metadata.file'] = key
+            stamps.append(UpdateMany(
+                {'filename': path, 'metadata.schema': None},
+                {'$set': stamp}))
+        self._files_metadata.bulk_write(stamps, ordered=False,
+                                        session=self._session)
 
     def rename_file(self, old_path, new_path):
         return self._rename_file(self.normalize_path(old_path),
                                  self.normalize_path(new_path))
 
     def _rename_file(self, old_path, new_path):
-        self._update_file_metadata(old_path,
-                                   filename=new_path,
-                                   name=os.path.basename(new_path),
-                                   path=new_path)
+        old_ancestors = self._ancestors(old_path)
+        new_ancestors = self._ancestors(new_path)
+        if self.quotas:
+            # only the head moves, so only its size counts against new quotas
+            head = self._heads.find_one(
+                {'path': old_path, **self._shard_query(old_path),
+                 'state': 'live'},
+                projection={'length': 1},
+                session=self._session)
+            if head is not None:
+                self._check_quota(new_path, head['length'],
+                                  ancestors=[a for a in new_ancestors
+                                             if a not in old_ancestors])
+        # moving the head is a single update; the unique index on live paths
+        # rejects it if a file already exists at new_path. In sharding mode,
+        # moving to another owner/project also moves it to another shard.
+        try:
+            head = self._heads.find_one_and_update(
+                {'path': old_path, **self._shard_query(old_path),
+                 'state': 'live'},
+                {'$set': {'path': new_path,
+                          'name': os.path.basename(new_path),
+                          **self._shard_query(new_path)}},
+                session=self._session)
+        except DuplicateKeyError:
+            raise web.HTTPError(409, u'File already exists: {}'.format(
+                self.denormalize_path(new_path)))
+        if head is None:
+            raise FileNotFoundError
+        # the head revision follows, so that its content is read from the
+        # shard of its new path; older revisions stay where they are and are
+        # found through the file they belong to
+        shard = ({'metadata.shard': self._shard(new_path)}
+                 if self.shard_key_depth else {})
+        self._files_metadata.update_one(
+            {'_id': head['file_id'], 'filename': old_path,
+             **self._shard_query(old_path, 'metadata.shard')},
+            {'$set': {'filename': new_path,
+                      'metadata.name': os.path.basename(new_path),
+                      'metadata.path': new_path,
+                      **shard}},
+            session=self._session)
+        self._adjust_usage([a for a in old_ancestors
+                            if a not in new_ancestors], -head['length'], -1)
+        self._adjust_usage([a for a in new_ancestors
+                            if a not in old_ancestors], head['length'], 1)
 
     def save(self, model: dict, path: str):
         """Save a file or directory model to path.
@@ -414,6 +989,12 @@ class MongoContents(ContentsManager):
         Should return the saved model with no content. Save implementations
         should call self.run_pre_save_hook(model=model, path=path) prior to
         writing any data.
+
+        Saves of files and notebooks may be made conditional by including
+        either an 'expected_revision' (the 'revision' of a model returned by
+        get) or an 'expected_last_modified' key in the model. If the head of
+        the file no longer matches, nothing is written and a 409 error is
+        raised.
         """
         if 'type' not in model:
             raise web.HTTPError(400, u'No file type provided')
@@ -443,19 +1024,127 @@ class MongoContents(ContentsManager):
 
         return self.get(path, content=False)
 
+    def _directory_document(self, path, created=None, last_modified=None) \
+            -> dict:
+        """Build the document stored in the directories collection."""
+        now = datetime.datetime.now()
+        return {
+            'path': path,
+            **self._shard_query(path),
+            'created': created if created is not None else now,
+            'last_modified': (last_modified if last_modified is not None
+                              else now),
+        }
+
     def _save_directory(self, model, path):
         try:
-            result = self._directories.insert_one({
-                'path': path,
-                'created': datetime.datetime.now(),
-                'last_modified': datetime.datetime.now(),
-            })
+            result = self._directories.insert_one(
+                self._directory_document(path), session=self._session)
         except DuplicateKeyError:
             self.log.debug('Tried to create directory {} which already exists'
                            .format(path))
         return model
 
+    @staticmethod
+    def _parse_datetime(value) -> datetime.datetime:
+        """Parse a datetime sent by a client into a naive local datetime.
+
+        Datetimes are stored as naive local times, but the REST API serializes
+        them as ISO 8601 strings with a UTC offset."""
+        if isinstance(value, str):
+            try:
+                value = datetime.datetime.fromisoformat(
+                    re.sub(r'Z$', '+00:00', value))
+            except ValueError:
+                raise web.HTTPError(400, u'Invalid expected_last_modified')
+        if not isinstance(value, datetime.datetime):
+            raise web.HTTPError(400, u'Invalid expected_last_modified')
+        if value.tzinfo is not None:
+            value = value.astimezone().replace(tzinfo=None)
+        return value
+
+    def _expected_head_filter(self, model) -> Union[dict, None]:
+        """Get the query matching the head the client expects to replace.
+
+        Returns None if the save is unconditional."""
+        if model.get('expected_revision') is not None:
+            try:
+                return {'file_id': ObjectId(model['expected_revision'])}
+            except (InvalidId, TypeError):
+                raise web.HTTPError(400, u'Invalid expected_revision')
+        if model.get('expected_last_modified') is not None:
+            return {'last_modified': self._parse_datetime(
+                model['expected_last_modified'])}
+        return None
+
+    def _promote(self, path, fields: dict, created, expected: dict,
+                 key: ObjectId) -> Union[dict, None]:
+        """Atomically make a stored revision the head of path.
+
+        fields are the head fields of the revision (see _head_fields). An
+        unconditional save (expected is None) replaces whatever the head is,
+        creating it (with the id key) for a new file; a conditional one only
+        replaces a head matching expected. Either way this is a single update of the head
+        document, so the file always has exactly one head.
+
+        Returns the previous head document, or None for a new file. Raises a
+        409 HTTPError if the head has changed (or the file has been deleted)
+        since the client read it."""
+        query = {'path': path, **self._shard_query(path), 'state': 'live'}
+        update = {'$set': fields, '$inc': {'revision_number': 1}}
+        if expected is None:
+            update['$setOnInsert'] = {'_id': key, 'created': created}
+            while True:
+                try:
+                    return self._heads.find_one_and_update(
+                        query, update, upsert=True, session=self._session)
+                except DuplicateKeyError:
+                    # another save created the file first; replace its head
+                    continue
+
+        result = self._heads.find_one_and_update(
+            {**query, **expected}, update, session=self._session)
+        if result is not None:
+            return result
+
+        # the compare-and-swap missed; find out why (this only touches
+        # metadata, never content)
+        raise self._conflict(path, self._heads.find_one(
+            query, projection={'last_modified': 1}, session=self._session))
+
+    def _conflict(self, path, head: Union[dict, None]) -> web.HTTPError:
+        """Build the 409 HTTPError of a conditional save of path which found
+        head (None if the file has been deleted) instead of the expected
+        one."""
+        if head is None:
+            return web.HTTPError(
+                409, u'File {} was deleted since it was last read'
+                .format(self.denormalize_path(path)))
+        return web.HTTPError(
+            409, u'File {} has been modified since it was last read '
+                 u'(now last modified {})'
+            .format(self.denormalize_path(path), head['last_modified']))
+
     def _save_file(self, model, path, file_type='file'):
+        data = model["content"].encode()
+        expected = self._expected_head_filter(model)
+        # an indexed lookup of the head tells which file the new revision
+        # belongs to, and turns stale conditional saves away before anything
+        # is uploaded; _promote still makes the final, atomic check
+        head = self._heads.find_one(
+            {'path': path, **self._shard_query(path), 'state': 'live'},
+            projection={'file_id': 1, 'last_modified': 1},
+            session=self._session)
+        if expected is not None and (
+                head is None or any(head[key] != value
+                                    for key, value in expected.items())):
+            raise self._conflict(path, head)
+        # revisions belong to a file (the _id of its head document) rather
+        # than a path, so that they follow it through renames and into the
+        # trash, and a file created at the same path later has its own
+        new_key = ObjectId()
+        key = head['_id'] if head is not None else new_key
+        self._check_quota(path, len(data))
         file_metadata = {
             'name': os.path.basename(path),
             'path': path,
@@ -464,16 +1153,221 @@ class MongoContents(ContentsManager):
             'last_modified': model['last_modified'],
             'mimetype': model['mimetype'],
             'format': model['format'] if 'format' in model else None,
+            'schema': _schema_version,
+            'file': key,
+            **self._shard_query(path),
         }
+        # the new revision is invisible until it is promoted to be the head,
+        # so the file keeps its current head while this uploads
         file: GridIn = self._files.open_upload_stream(
-            filename=path, metadata=file_metadata)
-        if 'mimetype' is not None:
+            filename=path, metadata=file_metadata, session=self._session)
+        if model['mimetype'] is not None:
             file.content_type = model['mimetype']
-        file.write(model["content"].encode())
+        file.write(data)
         file.close()
+        try:
+            previous = self._promote(
+                path, self._head_fields(file._id, file_metadata, len(data)),
+                model['created'], expected, new_key)
+        except web.HTTPError:
+            self._files.delete(file._id, session=self._session)
+            raise
+        promoted_key = previous['_id'] if previous is not None else new_key
+        if promoted_key != key:
+            # the file was deleted or created by someone else meanwhile
+            self._files_metadata.update_one(
+                {'_id': file._id, 'filename': path,
+                 **self._shard_query(path, 'metadata.shard')},
+                {'$set': {'metadata.file': promoted_key}},
+                session=self._session)
+        self._adjust_usage(self._ancestors(path), len(data), 1)
+        if self.revision_storage == 'delta' and previous is not None:
+            self._store_delta(path, previous, file._id, data)
         self.log.debug(f"Saved file {path} model {repr(model)}")
         return {key: model[key] for key in model.keys() if key != 'content'}
 
+    def _store_delta(self, path, previous: dict, base_id, base: bytes):
+        """Replace the content of the superseded head previous by a delta
+        against its successor (base_id, whose content is base).
+
+        The delta is uploaded as a GridFS file of its own and the revision is
+        switched over to it by a single update, conditional on the revision
+        still being stored in full; only then are its chunks removed. Readers
+        therefore see either the full content or the delta, and a crash at
+        any point loses nothing (at worst, an unused delta or the old chunks
+        are left behind).
+
+        Keyframes, binary content and revisions for which the delta would not
+        be smaller are left alone. Costs one read of the previous content."""
+        if (self.keyframe_interval <= 1
+                or previous.get('format') not in ('text', 'json')
+                or (previous.get('revision_number', 1) - 1)
+                % self.keyframe_interval == 0):
+            return
+        content = self._open_revision(path, previous['file_id']).read()
+        encoded = diff(base, content)
+        if len(encoded) >= len(content):
+            return
+        delta_id = self._files.upload_from_stream(
+            path, encoded,
+            metadata={'delta_of': previous['file_id'],
+                      'file': previous['_id'],
+                      'schema': _schema_version,
+                      **self._shard_query(path)},
+            session=self._session)
+        result = self._files_metadata.update_one(
+            {'_id': previous['file_id'], 'filename': path,
+             **self._shard_query(path, 'metadata.shard'),
+             'metadata.storage': {'$ne': 'delta'}},
+            {'$set': {'length': 0,
+                      'metadata.storage': 'delta',
+                      'metadata.delta': delta_id,
+                      'metadata.delta_base': base_id,
+                      'metadata.delta_length': len(encoded),
+                      'metadata.full_length': len(content)},
+             '$unset': {'md5': ''}},
+            session=self._session)
+        if result.modified_count == 0:
+            self._files.delete(delta_id, session=self._session)
+            return
+        self._database[self.files_collection_name].chunks.delete_many(
+            {'files_id': previous['file_id']}, session=self._session)
+        self._adjust_usage(self._ancestors(path),
+                           len(encoded) - len(content), 1)
+
+    def _read_revision(self, file_id) -> bytes:
+        """Read the full content of any revision, applying deltas as needed.
+
+        Deltas point at their successor, which may have been renamed to
+        another path (and so live on another shard), so they are looked up by
+        id alone. A revision which is turned into a delta while it is being
+        read is looked up again."""
+        while True:
+            chain = []
+            document = self._files_metadata.find_one(
+                {'_id': file_id}, projection={'metadata': 1},
+                session=self._session)
+            while (document is not None
+                   and document['metadata'].get('storage') == 'delta'):
+                chain.append(document['metadata']['delta'])
+                document = self._files_metadata.find_one(
+                    {'_id': document['metadata']['delta_base']},
+                    projection={'metadata': 1},
+                    session=self._session)
+            if document is None:
+                raise web.HTTPError(404, u'Revision {} is no longer available'
+                                    .format(file_id))
+            try:
+                file = self._content_files.open_download_stream(
+                    document['_id'], session=self._session)
+                if file.metadata.get('storage') != 'delta':
+                    data = file.read()
+                    break
+            except CorruptGridFile:
+                # its chunks were removed while we read them
+                pass
+        for delta_id in reversed(chain):
+            data = patch(data, self._content_files.open_download_stream(
+                delta_id, session=self._session).read())
+        return data
+
+    def list_revisions(self, path) -> List[dict]:
+        """List the stored revisions of a file, newest first.
+
+        Parameters
+        ----------
+        path : string
+            The API path of the file.
+
+        Returns
+        -------
+        revisions : list of dicts
+            - revision (unicode)
+                the revision id, as accepted by get_revision
+            - last_modified (datetime)
+                when the revision was saved
+            - length (int)
+                size of the revision's content
+            - stored_length (int)
+                number of bytes actually stored (smaller for deltas)
+            - head (bool)
+                whether this is the current revision
+        """
+        normal_path = self.normalize_path(path)
+        head = self._heads.find_one(
+            {'path': normal_path, **self._shard_query(normal_path),
+             'state': 'live'},
+            projection={'file_id': 1},
+            session=self._session)
+        if head is None:
+            return []
+        # including those stored under earlier names of the file (in sharding
+        # mode, possibly on other shards)
+        revisions = self._files_metadata.find(
+            {'metadata.file': head['_id'],
+             'metadata.delta_of': {'$exists': False}},
+            projection={'metadata': 1, 'length': 1},
+            sort=[('uploadDate', -1)],
+            session=self._session)
+        return [{
+            'revision': str(revision['_id']),
+            'last_modified': revision['metadata']['last_modified'],
+            'length': revision['metadata'].get('full_length',
+                                               revision['length']),
+            'stored_length': revision['metadata'].get('delta_length',
+                                                      revision['length']),
+            'head': revision['_id'] == head['file_id'],
+        } for revision in revisions]
+
+    def get_revision(self, path, revision, content=True) -> dict:
+        """Get the model of a file or notebook as of an older revision.
+
+        See get for the model format; revision is a revision id as returned
+        by list_revisions."""
+        normal_path = self.normalize_path(path)
+        try:
+            file_id = ObjectId(revision)
+        except (InvalidId, TypeError):
+            raise web.HTTPError(400, u'Invalid revision')
+        head = self._heads.find_one(
+            {'path': normal_path, **self._shard_query(normal_path),
+             'state': 'live'},
+            projection={'_id': 1},
+            session=self._session)
+        document = None
+        if head is not None:
+            document = self._files_metadata.find_one(
+                {'_id': file_id, 'metadata.file': head['_id'],
+                 'metadata.delta_of': {'$exists': False}},
+                projection={'metadata': 1},
+                session=self._session)
+        if document is None:
+            raise web.HTTPError(404, u'No revision {} of {}'
+                                .format(revision, path))
+        metadata = document['metadata']
+        model = {
+            'name': os.path.basename(normal_path),
+            'path': self.denormalize_path(normal_path),
+            'format': metadata['format'],
+            'mimetype': metadata['mimetype'],
+            'type': metadata['type'],
+            'created': metadata['created'],
+            'last_modified': metadata['last_modified'],
+            'revision': revision,
+            'writable': False,
+            'content': None,
+        }
+        if not content:
+            return model
+        data = self._read_revision(file_id).decode()
+        if metadata['type'] == 'notebook':
+            model['format'] = 'json'
+            model['content'] = nbformat.notebooknode.from_dict(
+                json.loads(data))
+        else:
+            model['content'] = data
+        return model
+
     def _save_notebook(self, model, path):
         model['format'] = 'json'
         json_serialization = json.dumps(model['content'])
@@ -486,3 +1380,199 @@ class MongoContents(ContentsManager):
         self.log.debug(f"Saved notebook {path} model {repr(result)}")
         return {key: model[key] for key in model.keys()
                 if (key != 'content' and key != 'format')}
+
+    @staticmethod
+    def _ancestors(path) -> List[str]:
+        """Get the (normalized) directory paths containing path.
+
+        The nearest directory comes first and the root last."""
+        ancestors = []
+        parent = os.path.dirname(path.rstrip('/'))
+        while parent not in ancestors:
+            ancestors.append(parent)
+            parent = os.path.dirname(parent)
+        return ancestors
+
+    def _adjust_usage(self, ancestors: List[str], length: int, count: int):
+        """Add length bytes and count GridFS files to the usage counters of
+        each of the given directories."""
+        if not ancestors or (length == 0 and count == 0):
+            return
+        self._usage.bulk_write(
+            [UpdateOne({'_id': ancestor},
+                       {'$inc': {'length': length, 'count': count}},
+                       upsert=True)
+             for ancestor in ancestors],
+            ordered=False,
+            session=self._session)
+
+    def _check_quota(self, path, length: int, ancestors: List[str] = None):
+        """Raise a 507 HTTPError if storing length more bytes at path would
+        exceed the quota of any directory containing it.
+
+        The check is not atomic with the subsequent write, so concurrent saves
+        may overshoot a quota by at most their combined size."""
+        if not self.quotas:
+            return
+        if ancestors is None:
+            ancestors = self._ancestors(path)
+        quotas = {}
+        for quota_path, quota in self.quotas.items():
+            quota_path = self.normalize_path(quota_path).rstrip('/') or '/'
+            if quota_path in ancestors:
+                quotas[quota_path] = quota
+        if not quotas:
+            return
+        usage = self._usage.find({'_id': {'$in': list(quotas.keys())}},
+                                 session=self._session)
+        used = {document['_id']: document['length'] for document in usage}
+        for quota_path, quota in quotas.items():
+            if used.get(quota_path, 0) + length > quota:
+                raise web.HTTPError(
+                    507, u'Storage quota of {} bytes for {} exceeded (older '
+                         u'revisions and deleted files count until they are '
+                         u'removed with prune_revisions or empty_trash)'
+                    .format(quota, self.denormalize_path(quota_path) or '/'))
+
+    def get_usage(self, path='') -> dict:
+        """Get the storage used under a directory.
+
+        Usage counts every stored revision of every file (including deleted
+        files which have not yet been purged); see prune_revisions and
+        empty_trash for freeing space.
+
+        Parameters
+        ----------
+        path : string
+            The API path of the directory.
+
+        Returns
+        -------
+        usage : dict
+            - path (unicode)
+                the API path of the directory
+            - length (int)
+                total number of bytes stored
+            - count (int)
+                total number of stored revisions
+            - quota (int or None)
+                the configured quota for the directory, if any
+        """
+        normal_path = self.normalize_path(path).rstrip('/') or '/'
+        document = self._usage.find_one({'_id': normal_path},
+                                        session=self._session)
+        quotas = {self.normalize_path(key).rstrip('/') or '/': value
+                  for key, value in self.quotas.items()}
+        return {
+            'path': path,
+            'length': document['length'] if document is not None else 0,
+            'count': document['count'] if document is not None else 0,
+            'quota': quotas.get(normal_path),
+        }
+
+    def reconcile_usage(self, settle=1.0, attempts=5) -> int:
+        """Correct usage counters which have drifted from the stored files.
+
+        Safe to run while the server is in use. Directories are reconciled
+        deepest first, each against the files directly inside it plus the
+        (by then reconciled) counters of its subdirectories, so no single
+        measurement has to scan more than one directory. Writers update the
+        counters just after the files they change, so a difference may only
+        be a write in flight: a counter is corrected only if it is off by
+        the same amount in two measurements settle seconds apart, and the
+        correction is an $inc conditional on the counter not having changed
+        since it was measured. Directories still changing after attempts
+        rounds are left alone (and logged); running this again picks them
+        up. Counters of directories which no longer hold anything are
+        removed. Returns the number of counters corrected."""
+        directories = {document['_id'] for document in self._usage.find(
+            {}, projection={'_id': 1}, session=self._session)}
+        for document in self._files_metadata.find(
+                {}, projection={'filename': 1}, session=self._session):
+            directories.update(self._ancestors(document['filename']))
+        children = defaultdict(list)
+        levels = defaultdict(list)
+        for directory in directories:
+            parent = os.path.dirname(directory)
+            if parent != directory:
+                children[parent].append(directory)
+            levels[directory.rstrip('/').count('/')].append(directory)
+
+        corrected = 0
+        for depth in sorted(levels, reverse=True):
+            pending = levels[depth]
+            for _ in range(attempts):
+                if not pending:
+                    break
+                first = {directory: self._usage_drift(directory,
+                                                      children[directory])
+                         for directory in pending}
+                time.sleep(settle)
+                unsettled = []
+                for directory in pending:
+                    counter, drift = self._usage_drift(directory,
+                                                       children[directory])
+                    if drift != first[directory][1]:
+                        unsettled.append(directory)
+                    elif drift != (0, 0):
+                        if self._correct_usage(directory, counter, drift):
+                            corrected += 1
+                        else:
+                            unsettled.append(directory)
+                pending = unsettled
+            if pending:
+                self.log.warning(
+                    f"Usage of {len(pending)} directories kept changing and "
+                    f"was not reconciled: {sorted(pending)}")
+        self._usage.delete_many({'length': 0, 'count': 0},
+                                session=self._session)
+        return corrected
+
+    def _usage_drift(self, path, children: List[str]) -> tuple:
+        """Measure how far the usage counter of the directory path is off.
+
+        Returns the counter as read (None if there is none) and the
+        (length, count) which would have to be added to it to match the
+        files directly in path plus the counters of its children. The
+        counter is read first, so a write in flight during the measurement
+        shows up as a drift."""
+        counter = self._usage.find_one({'_id': path}, session=self._session)
+        regex = '^' + re.escape(path.rstrip('/') + '/') + r'[^/]+$'
+        totals = list(self._files_metadata.aggregate([
+            {'$match': {'filename': {'$regex': regex},
+                        **self._descendants_shard_query(path,
+                                                        'metadata.shard')}},
+            {'$group': {'_id': None,
+                        'length': {'$sum': '$length'},
+                        'count': {'$sum': 1}}},
+        ], session=self._session))
+        length = totals[0]['length'] if totals else 0
+        count = totals[0]['count'] if totals else 0
+        for child in self._usage.find({'_id': {'$in': children}},
+                                      session=self._session):
+            length += child['length']
+            count += child['count']
+        if counter is not None:
+            length -= counter['length']
+            count -= counter['count']
+        return counter, (length, count)
+
+    def _correct_usage(self, path, counter: Union[dict, None],
+                       drift: tuple) -> bool:
+        """Add drift to the usage counter of path, unless the counter has
+        changed since it was read as counter; returns whether it was
+        corrected."""
+        if counter is None:
+            try:
+                self._usage.insert_one(
+                    {'_id': path, 'length': drift[0], 'count': drift[1]},
+                    session=self._session)
+            except DuplicateKeyError:
+                return False
+            return True
+        result = self._usage.update_one(
+            {'_id': path, 'length': counter['length'],
+             'count': counter['count']},
+            {'$inc': {'length': drift[0], 'count': drift[1]}},
+            session=self._session)
+        return result.modified_count == 1
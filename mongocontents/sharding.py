@@ -0,0 +1,146 @@
+"""Set up a sharded cluster for MongoContents.
+
+In sharding mode (MongoContents.shard_key_depth > 0) every directory and file
+carries a `shard` field: a hash of the first shard_key_depth components of
+its path (e.g. the owner, or owner/project). Each collection is sharded so
+that everything belonging to one owner/project lives on a single shard:
+
+- directories: {shard: 1, path: 1} (unique, which also enforces unique paths)
+- <files>.files: {metadata.shard: 1, filename: 1}
+- <files>.chunks: {files_id: 'hashed'}
+- usage: {_id: 'hashed'}
+- heads: {shard: 1, path: 1}
+
+Since the shard field is itself a hash, ranged sharding on it distributes
+owners as evenly as hashed sharding would, while still allowing the unique
+indexes on paths. Unlike hashed sharding, though, it does not pre-split empty
+collections, so everything would start out on a single shard (and stay there
+until the balancer catches up). shard_collections therefore splits each range
+sharded collection into one equal range of the shard field per shard and moves
+each range to its own shard.
+
+Chunks carry no path, only the (ObjectId) id of their file. ObjectIds increase
+monotonically, so with the usual ranged {files_id: 1, n: 1} key every new chunk
+would fall into the topmost range and all uploads would hit a single shard.
+Hashing files_id spreads the writes evenly, while all chunks of one file still
+share a files_id, so reading a file is still routed to a single shard.
+
+Every query made by MongoContents on a path below shard_key_depth includes
+the shard field and is routed to a single shard. Listing directories above
+that depth (e.g. the root when shard_key_depth is 1) is broadcast to every
+shard.
+
+Existing, unsharded data does not have shard fields; migrate it by exporting
+it and importing it again with mongocontents.bulk.
+
+Command line usage (against a mongos)::
+
+    python -m mongocontents.sharding --shard-key-depth 1 [--mongodb-uri URI]
+"""
+import argparse
+from typing import List
+from bson import MinKey
+from pymongo.errors import OperationFailure
+from .mongocontents import MongoContents
+
+
+def shard_key_patterns(contents: MongoContents) -> dict:
+    """Get the shard key of each collection, by full collection name."""
+    database = contents.database_name
+    files = contents.files_collection_name
+    return {
+        '{}.{}'.format(database, contents.directories_collection_name):
+            ({'shard': 1, 'path': 1}, True),
+        '{}.{}.files'.format(database, files):
+            ({'metadata.shard': 1, 'filename': 1}, False),
+        '{}.{}.chunks'.format(database, files):
+            ({'files_id': 'hashed'}, False),
+        '{}.{}'.format(database, contents.usage_collection_name):
+            ({'_id': 'hashed'}, False),
+        '{}.{}'.format(database, contents.heads_collection_name):
+            ({'shard': 1, 'path': 1}, False),
+    }
+
+
+def split_points(shards: int) -> List[str]:
+    """Get the values of the (hexadecimal) shard field which split its range
+    into shards equal parts."""
+    return ['{:04x}'.format(i * 0x10000 // shards) for i in range(1, shards)]
+
+
+def _distribute(contents: MongoContents, namespace: str, key: dict,
+                shards: List[str]):
+    """Split the range sharded collection namespace into one range of the
+    shard field per shard and move each range to its shard."""
+    admin = contents._client.admin
+    field, *others = key
+    lower_bounds = [''] + split_points(len(shards))
+    for point in lower_bounds[1:]:
+        admin.command('split', namespace,
+                      middle={field: point,
+                              **{other: MinKey() for other in others}})
+    for lower, shard in zip(lower_bounds, shards):
+        try:
+            admin.command('moveChunk', namespace,
+                          find={field: lower, **{other: '' for other in others}},
+                          to=shard)
+        except OperationFailure as e:
+            # the range is on that shard already
+            if 'already' not in str(e):
+                raise
+
+
+def shard_collections(contents: MongoContents):
+    """Create the shard-aware indexes and shard every collection.
+
+    contents must be connected to a mongos and configured with a non-zero
+    shard_key_depth. Range sharded collections are spread evenly over the
+    shards (see split_points). Collections which are already sharded are left
+    alone.
+    """
+    if not contents.shard_key_depth:
+        raise ValueError("shard_key_depth must be set to shard collections")
+    contents.create_indices()
+    # the chunks index is normally only created by the first upload
+    contents._database[contents.files_collection_name].chunks.create_index(
+        [('files_id', 1), ('n', 1)], unique=True)
+
+    admin = contents._client.admin
+    admin.command('enableSharding', contents.database_name)
+    shards = [shard['_id'] for shard in admin.command('listShards')['shards']]
+    config = contents._client.config
+    for namespace, (key, unique) in shard_key_patterns(contents).items():
+        if config.collections.find_one({'_id': namespace,
+                                        'dropped': {'$ne': True}}):
+            contents.log.info(f"{namespace} is already sharded")
+            continue
+        admin.command('shardCollection', namespace, key=key, unique=unique)
+        if len(shards) > 1 and 'hashed' not in key.values():
+            _distribute(contents, namespace, key, shards)
+        contents.log.info(f"Sharded {namespace} on {key}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m mongocontents.sharding',
+        description="Shard the MongoContents collections.")
+    parser.add_argument('--mongodb-uri', default=None,
+                        help="URI of a mongos (defaults to MongoContents' "
+                             "default).")
+    parser.add_argument('--database', default=None,
+                        help="Database in which files are stored.")
+    parser.add_argument('--shard-key-depth', type=int, required=True,
+                        help="Number of leading path components in the "
+                             "shard key.")
+    args = parser.parse_args(argv)
+
+    options = {'shard_key_depth': args.shard_key_depth}
+    if args.mongodb_uri is not None:
+        options['mongodb_uri'] = args.mongodb_uri
+    if args.database is not None:
+        options['database_name'] = args.database
+    shard_collections(MongoContents(**options))
+
+
+if __name__ == '__main__':
+    main()
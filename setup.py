@@ -38,6 +38,11 @@ setup(
       'traitlets',
       'requests'
     ],
+    entry_points={
+      'console_scripts': [
+        'mongocontents-bulk=mongocontents.bulk:main',
+      ],
+    },
     zip_safe=False,
     classifiers=[
       'Intended Audience :: End Users/Desktop'
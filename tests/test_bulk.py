@@ -0,0 +1,127 @@
+import json
+import os
+import os.path
+import tarfile
+import tempfile
+from unittest import TestCase
+from mongocontents import MongoContents
+from mongocontents.bulk import export_tree, import_tree
+
+
+class TestBulk(TestCase):
+    contents: MongoContents
+
+    def setUp(self):
+        self.contents = MongoContents()
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def reset_db(self):
+        self.contents._client.drop_database(self.contents.database_name)
+        self.contents = MongoContents()
+
+    def fixture1(self):
+        """Create a small local tree and return its path."""
+        root = os.path.join(self.tmp.name, 'source')
+        os.makedirs(os.path.join(root, 'project', 'data'))
+        os.makedirs(os.path.join(root, 'empty'))
+        os.makedirs(os.path.join(root, '.ipynb_checkpoints'))
+        with open(os.path.join(root, 'readme.txt'), 'w') as f:
+            f.write('Some text')
+        with open(os.path.join(root, 'project', 'data', 'blob.bin'),
+                  'wb') as f:
+            f.write(bytes(range(256)) * 10)
+        with open(os.path.join(root, 'project', 'nb.ipynb'), 'w') as f:
+            json.dump({'metadata': {}, 'nbformat': 4, 'nbformat_minor': 0,
+                       'cells': []}, f)
+        with open(os.path.join(root, '.ipynb_checkpoints', 'x.txt'),
+                  'w') as f:
+            f.write('checkpoint')
+        return root
+
+    def assert_tree(self, prefix=''):
+        assert self.contents.get(prefix + 'readme.txt')['content'] \
+            == 'Some text'
+        assert self.contents.get(prefix + 'project/nb.ipynb')['type'] \
+            == 'notebook'
+        blob = self.contents.get(prefix + 'project/data/blob.bin')
+        assert blob['format'] == 'base64'
+        assert self.contents.dir_exists(prefix + 'empty')
+        assert not self.contents.dir_exists(prefix + '.ipynb_checkpoints')
+
+    def test_import(self):
+        self.reset_db()
+        stats = import_tree(self.contents, self.fixture1(), 'alice',
+                            workers=2)
+        assert stats.files == 3
+        assert stats.bytes > 2560
+        self.assert_tree('alice/')
+        names = [item['name'] for item in self.contents.get('alice')['content']]
+        assert names == ['empty', 'project', 'readme.txt']
+
+    def test_import_resume(self):
+        self.reset_db()
+        root = self.fixture1()
+        import_tree(self.contents, root)
+        readme = os.path.join(root, 'readme.txt')
+        with open(readme, 'w') as f:
+            f.write('Changed')
+        modified = os.stat(readme).st_mtime + 10
+        os.utime(readme, (modified, modified))
+        stats = import_tree(self.contents, root)
+        assert stats.files == 1
+        assert stats.skipped == 2
+        assert self.contents.get('readme.txt')['content'] == 'Changed'
+
+    def test_import_keeps_newer(self):
+        self.reset_db()
+        root = self.fixture1()
+        import_tree(self.contents, root)
+        self.contents.save({'content': 'Edited', 'format': 'text',
+                            'mimetype': 'text/plain', 'type': 'file'},
+                           'readme.txt')
+        stats = import_tree(self.contents, root)
+        assert stats.files == 0
+        assert stats.skipped == 3
+        assert self.contents.get('readme.txt')['content'] == 'Edited'
+        stats = import_tree(self.contents, root, force=True)
+        assert stats.files == 3
+        assert self.contents.get('readme.txt')['content'] == 'Some text'
+
+    def test_export_roundtrip(self):
+        self.reset_db()
+        root = self.fixture1()
+        import_tree(self.contents, root, 'alice')
+        dest = os.path.join(self.tmp.name, 'dest')
+        stats = export_tree(self.contents, 'alice', dest, workers=2)
+        assert stats.files == 3
+        for relative in ['readme.txt', 'project/nb.ipynb',
+                         'project/data/blob.bin']:
+            with open(os.path.join(root, relative), 'rb') as f:
+                expected = f.read()
+            with open(os.path.join(dest, relative), 'rb') as f:
+                assert f.read() == expected
+        assert os.path.isdir(os.path.join(dest, 'empty'))
+        stats = export_tree(self.contents, 'alice', dest)
+        assert stats.files == 0
+        assert stats.skipped == 3
+
+    def test_tar_roundtrip(self):
+        self.reset_db()
+        root = self.fixture1()
+        archive = os.path.join(self.tmp.name, 'source.tar.gz')
+        with tarfile.open(archive, 'w:gz') as tar:
+            tar.add(root, arcname='.')
+        stats = import_tree(self.contents, archive, 'bob', tar=True)
+        assert stats.files == 3
+        self.assert_tree('bob/')
+        exported = os.path.join(self.tmp.name, 'export.tar')
+        export_tree(self.contents, 'bob', exported, tar=True)
+        with tarfile.open(exported) as tar:
+            names = set(tar.getnames())
+            blob = tar.extractfile('project/data/blob.bin').read()
+        assert names == {'empty', 'project', 'project/data', 'readme.txt',
+                         'project/nb.ipynb', 'project/data/blob.bin'}
+        assert blob == bytes(range(256)) * 10
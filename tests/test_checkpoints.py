@@ -0,0 +1,52 @@
+from unittest import TestCase
+from tornado import web
+from mongocontents import MongoContents
+
+
+class TestCheckpoints(TestCase):
+    contents: MongoContents
+
+    def setUp(self):
+        self.contents = MongoContents()
+
+    def reset_db(self):
+        self.contents._client.drop_database(self.contents.database_name)
+        self.contents = MongoContents()
+
+    @staticmethod
+    def fixture1(content='Some text'):
+        return {
+            'content': content,
+            'format': 'text',
+            'mimetype': 'text/plain',
+            'type': 'file'
+        }
+
+    def test_create_and_restore(self):
+        self.reset_db()
+        self.contents.save(self.fixture1('one'), 'foo.txt')
+        assert self.contents.list_checkpoints('foo.txt') == []
+        checkpoint = self.contents.create_checkpoint('foo.txt')
+        assert self.contents.list_checkpoints('foo.txt') == [checkpoint]
+        self.contents.save(self.fixture1('two'), 'foo.txt')
+        self.contents.restore_checkpoint(checkpoint['id'], 'foo.txt')
+        assert self.contents.get('foo.txt')['content'] == 'one'
+        # restoring is a save, so the edit is still in the history
+        assert len(self.contents.list_revisions('foo.txt')) == 3
+
+    def test_rename_and_delete(self):
+        self.reset_db()
+        self.contents.save(self.fixture1('one'), 'foo.txt')
+        checkpoint = self.contents.create_checkpoint('foo.txt')
+        # the wrappers the REST handlers use, which go through checkpoints
+        self.contents.rename('foo.txt', 'bar.txt')
+        assert self.contents.list_checkpoints('foo.txt') == []
+        assert self.contents.list_checkpoints('bar.txt') == [checkpoint]
+        self.contents.delete_checkpoint(checkpoint['id'], 'bar.txt')
+        assert self.contents.list_checkpoints('bar.txt') == []
+        with self.assertRaises(web.HTTPError) as context:
+            self.contents.restore_checkpoint(checkpoint['id'], 'bar.txt')
+        assert context.exception.status_code == 404
+        self.contents.create_checkpoint('bar.txt')
+        self.contents.delete('bar.txt')
+        assert not self.contents.file_exists('bar.txt')
@@ -0,0 +1,175 @@
+import threading
+from unittest import TestCase
+from tornado import web
+from mongocontents import MongoContents
+
+
+class TestConditionalSave(TestCase):
+    contents: MongoContents
+
+    def setUp(self):
+        self.contents = MongoContents()
+
+    def reset_db(self):
+        self.contents._client.drop_database(self.contents.database_name)
+        self.contents = MongoContents()
+
+    @staticmethod
+    def fixture1(content='Some text'):
+        return {
+            'content': content,
+            'format': 'text',
+            'mimetype': 'text/plain',
+            'type': 'file'
+        }
+
+    def test_revision_in_model(self):
+        self.reset_db()
+        saved = self.contents.save(self.fixture1(), 'foo.txt')
+        file = self.contents.get('foo.txt')
+        assert file['revision'] == saved['revision']
+
+    def test_conditional_save(self):
+        self.reset_db()
+        first = self.contents.save(self.fixture1('one'), 'foo.txt')
+        model = self.fixture1('two')
+        model['expected_revision'] = first['revision']
+        second = self.contents.save(model, 'foo.txt')
+        assert second['revision'] != first['revision']
+        model = self.fixture1('three')
+        model['expected_last_modified'] = second['last_modified']
+        self.contents.save(model, 'foo.txt')
+        assert self.contents.get('foo.txt')['content'] == 'three'
+
+    def test_conflict(self):
+        self.reset_db()
+        first = self.contents.save(self.fixture1('one'), 'foo.txt')
+        self.contents.save(self.fixture1('two'), 'foo.txt')
+        model = self.fixture1('stale')
+        model['expected_revision'] = first['revision']
+        database = self.contents._database
+        database.command('profile', 2)
+        try:
+            with self.assertRaises(web.HTTPError) as context:
+                self.contents.save(model, 'foo.txt')
+        finally:
+            database.command('profile', 0)
+        assert context.exception.status_code == 409
+        assert self.contents.get('foo.txt')['content'] == 'two'
+        # the stale save was turned away before uploading anything
+        files_ns = '{}.{}.files'.format(self.contents.database_name,
+                                        self.contents.files_collection_name)
+        assert database['system.profile'].count_documents(
+            {'ns': files_ns, 'op': 'insert'}) == 0
+
+    def test_invalid_expectation(self):
+        self.reset_db()
+        self.contents.save(self.fixture1('one'), 'foo.txt')
+        for key, value in [('expected_revision', 'nope'),
+                           ('expected_last_modified', 'yesterday'),
+                           ('expected_last_modified', 1234567890)]:
+            model = self.fixture1('two')
+            model[key] = value
+            with self.assertRaises(web.HTTPError) as context:
+                self.contents.save(model, 'foo.txt')
+            assert context.exception.status_code == 400
+        assert self.contents.get('foo.txt')['content'] == 'one'
+
+    def test_conflict_after_delete(self):
+        self.reset_db()
+        first = self.contents.save(self.fixture1('one'), 'foo.txt')
+        self.contents.delete_file('foo.txt')
+        model = self.fixture1('two')
+        model['expected_revision'] = first['revision']
+        with self.assertRaises(web.HTTPError) as context:
+            self.contents.save(model, 'foo.txt')
+        assert context.exception.status_code == 409
+
+    def test_concurrent_writers(self):
+        self.reset_db()
+        head = self.contents.save(self.fixture1('base'), 'foo.txt')
+        writers = [MongoContents() for _ in range(8)]
+        database = self.contents._database
+        database.command('profile', 2)
+        barrier = threading.Barrier(len(writers))
+        saved = []
+        conflicts = []
+
+        def write(contents, i):
+            model = self.fixture1('writer {}'.format(i))
+            model['expected_revision'] = head['revision']
+            barrier.wait()
+            try:
+                saved.append(contents.save(model, 'foo.txt'))
+            except web.HTTPError as e:
+                assert e.status_code == 409
+                conflicts.append(i)
+
+        threads = [threading.Thread(target=write, args=(contents, i))
+                   for i, contents in enumerate(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        database.command('profile', 0)
+
+        # exactly one writer wins and nobody's update is silently lost
+        assert len(saved) == 1
+        assert len(conflicts) == len(writers) - 1
+        assert (self.contents.get('foo.txt')['revision']
+                == saved[0]['revision'])
+        # the losers' uploads are removed again
+        assert self.contents._files_metadata.count_documents(
+            {'filename': '/foo.txt'}) == 2
+        assert self.contents._heads.count_documents(
+            {'path': '/foo.txt', 'state': 'live'}) == 1
+        # the conflict checks never read file content (GridFS' own check
+        # for an empty collection at the start of each upload aside)
+        chunks_ns = '{}.{}.chunks'.format(self.contents.database_name,
+                                          self.contents.files_collection_name)
+        assert database['system.profile'].count_documents(
+            {'ns': chunks_ns, 'op': 'query',
+             'command.filter.files_id': {'$exists': True}}) == 0
+
+    def test_mixed_writers(self):
+        self.reset_db()
+        head = self.contents.save(self.fixture1('base'), 'foo.txt')
+        writers = [MongoContents() for _ in range(8)]
+        barrier = threading.Barrier(len(writers))
+        saved = []
+        conflicts = []
+
+        def write(contents, i):
+            model = self.fixture1('writer {}'.format(i))
+            if i % 2:
+                model['expected_revision'] = head['revision']
+            barrier.wait()
+            for _ in range(5):
+                try:
+                    contents.save(model, 'foo.txt')
+                    saved.append(i)
+                except web.HTTPError as e:
+                    assert e.status_code == 409
+                    conflicts.append(i)
+
+        threads = [threading.Thread(target=write, args=(contents, i))
+                   for i, contents in enumerate(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # unconditional writers always succeed, conditional ones at most once
+        assert len([i for i in saved if i % 2 == 0]) == 20
+        assert len([i for i in saved if i % 2]) <= 1
+        assert len(saved) + len(conflicts) == 40
+        # exactly one head, pointing at a stored revision
+        heads = list(self.contents._heads.find(
+            {'path': '/foo.txt', 'state': 'live'}))
+        assert len(heads) == 1
+        assert self.contents._files_metadata.count_documents(
+            {'_id': heads[0]['file_id']}) == 1
+        assert self.contents.get('foo.txt')['content'].startswith('writer')
+        # every successful save left a revision behind, every conflict none
+        assert self.contents._files_metadata.count_documents(
+            {'filename': '/foo.txt'}) == 1 + len(saved)
@@ -0,0 +1,144 @@
+import json
+from unittest import TestCase
+import nbformat.notebooknode
+from tornado import web
+from mongocontents import MongoContents
+from mongocontents.delta import diff, patch
+
+
+class TestDelta(TestCase):
+    contents: MongoContents
+
+    def setUp(self):
+        self.contents = MongoContents()
+
+    def reset_db(self):
+        self.contents._client.drop_database(self.contents.database_name)
+        self.contents = MongoContents(revision_storage='delta',
+                                      keyframe_interval=5)
+
+    @staticmethod
+    def fixture1(i):
+        lines = ['line {}\n'.format(n) for n in range(200)]
+        lines[i % 200] = 'changed in revision {}\n'.format(i)
+        return {
+            'content': ''.join(lines),
+            'format': 'text',
+            'mimetype': 'text/plain',
+            'type': 'file'
+        }
+
+    @staticmethod
+    def fixture2(i):
+        return {
+            'content': nbformat.notebooknode.from_dict({
+                'metadata': {},
+                'nbformat': 4,
+                'nbformat_minor': 0,
+                'cells': [
+                    {
+                        'cell_type': 'markdown',
+                        'metadata': {},
+                        'source': 'Cell {} of revision {}'.format(n, i),
+                    } for n in range(i + 1)
+                ],
+            }),
+            'type': 'notebook'
+        }
+
+    def test_diff_patch(self):
+        base = b'a\nb, c\nd'
+        for target in [b'', b'a\nb, c\nd', b'x\nb, c\nd\ne', b'b, c']:
+            assert patch(base, diff(base, target)) == target
+        notebook = json.dumps(self.fixture2(20)['content']).encode()
+        edited = notebook.replace(b'Cell 3 of', b'Edited cell 3 of')
+        assert len(diff(notebook, edited)) < len(edited) / 10
+
+    def test_revisions(self):
+        self.reset_db()
+        for i in range(12):
+            self.contents.save(self.fixture1(i), 'foo.txt')
+        revisions = self.contents.list_revisions('foo.txt')
+        assert len(revisions) == 12
+        assert revisions[0]['head']
+        # the head is stored in full, keyframes (0, 5, 10) too
+        stored = [r['stored_length'] == r['length'] for r in revisions]
+        assert stored == [True, True, False, False, False, False,
+                          True, False, False, False, False, True]
+        for i, revision in enumerate(reversed(revisions)):
+            model = self.contents.get_revision('foo.txt',
+                                               revision['revision'])
+            assert model['content'] == self.fixture1(i)['content']
+        assert self.contents.get('foo.txt')['content'] \
+            == self.fixture1(11)['content']
+
+    def test_notebook_revisions(self):
+        self.reset_db()
+        for i in range(4):
+            self.contents.save(self.fixture2(i), 'nb.ipynb')
+        revisions = self.contents.list_revisions('nb.ipynb')
+        assert revisions[1]['stored_length'] < revisions[1]['length']
+        model = self.contents.get_revision('nb.ipynb',
+                                           revisions[2]['revision'])
+        assert len(model['content']['cells']) == 2
+
+    def test_usage_counts_deltas(self):
+        self.reset_db()
+        for i in range(3):
+            self.contents.save(self.fixture1(i), 'foo.txt')
+        stored = sum(r['stored_length']
+                     for r in self.contents.list_revisions('foo.txt'))
+        assert self.contents.get_usage()['length'] == stored
+
+    def test_rename_keeps_history(self):
+        self.reset_db()
+        for i in range(3):
+            self.contents.save(self.fixture1(i), 'foo.txt')
+        revisions = self.contents.list_revisions('foo.txt')
+        self.contents.rename_file('foo.txt', 'bar.txt')
+        # the history follows the file to its new name
+        assert self.contents.list_revisions('bar.txt') == revisions
+        model = self.contents.get_revision('bar.txt',
+                                           revisions[1]['revision'])
+        assert model['content'] == self.fixture1(1)['content']
+        assert model['name'] == 'bar.txt'
+        # a new file at the old name starts a history of its own
+        self.contents.save(self.fixture1(7), 'foo.txt')
+        assert len(self.contents.list_revisions('foo.txt')) == 1
+        with self.assertRaises(web.HTTPError) as context:
+            self.contents.get_revision('foo.txt', revisions[1]['revision'])
+        assert context.exception.status_code == 404
+
+    def test_read_stale_head(self):
+        self.reset_db()
+        for i in range(2):
+            self.contents.save(self.fixture1(i), 'foo.txt')
+        stale = self.contents._get_head('/foo.txt')
+        # turns the revision stale points at into a delta
+        self.contents.save(self.fixture1(2), 'foo.txt')
+        head, data = self.contents._read_head('/foo.txt', stale)
+        assert head['file_id'] != stale['file_id']
+        assert data.decode() == self.fixture1(2)['content']
+        self.contents.delete_file('foo.txt')
+        assert self.contents._read_head('/foo.txt', stale) == (None, None)
+
+    def test_delta_stored_separately(self):
+        self.reset_db()
+        for i in range(3):
+            self.contents.save(self.fixture1(i), 'foo.txt')
+        revisions = self.contents.list_revisions('foo.txt')
+        assert len(revisions) == 3
+        middle = self.contents._files_metadata.find_one(
+            {'metadata.storage': 'delta'})
+        assert str(middle['_id']) == revisions[1]['revision']
+        chunks = self.contents._database[
+            self.contents.files_collection_name].chunks
+        # the revision's own chunks are gone; the delta has its own id
+        assert chunks.count_documents({'files_id': middle['_id']}) == 0
+        delta = self.contents._files_metadata.find_one(
+            {'metadata.delta_of': middle['_id']})
+        assert delta['_id'] == middle['metadata']['delta']
+        assert chunks.count_documents({'files_id': delta['_id']}) == 1
+        stored = self.contents.get_usage()['length']
+        self.contents.reconcile_usage()
+        assert self.contents.get_usage()['length'] == stored
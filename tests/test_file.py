@@ -1,4 +1,5 @@
 from unittest import TestCase
+from tornado import web
 from mongocontents import MongoContents
 
 
@@ -39,6 +40,15 @@ class TestSaveDirectory(TestCase):
         file = self.contents.get('foo.txt', type='file')
         assert file['content'] == model['content']
 
+    def test_model_without_content(self):
+        self.reset_db()
+        saved = self.contents.save(self.fixture1(), path='foo.txt')
+        # as the REST handlers validate models returned without content
+        for model in [saved, self.contents.get('foo.txt', content=False)]:
+            assert model['content'] is None
+            assert model['format'] is None
+        assert self.contents.get('foo.txt')['format'] == 'text'
+
     def test_save_in_directory(self):
         self.reset_db()
         self.contents.save({'type': 'directory'}, path='mydir')
@@ -69,3 +79,18 @@ class TestSaveDirectory(TestCase):
         self.contents.save(self.fixture1(), 'foo.txt')
         self.contents.rename_file('foo.txt', 'bar.txt')
         assert self.contents.get('bar.txt') is not None
+
+    def test_rename_onto_existing(self):
+        self.reset_db()
+        self.contents.save(self.fixture1(), 'foo.txt')
+        model = self.fixture1()
+        model['content'] = 'bar'
+        self.contents.save(model, 'bar.txt')
+        with self.assertRaises(web.HTTPError) as context:
+            self.contents.rename_file('foo.txt', 'bar.txt')
+        assert context.exception.status_code == 409
+        assert self.contents.get('bar.txt')['content'] == 'bar'
+        assert self.contents.file_exists('foo.txt')
+        with self.assertRaises(FileNotFoundError):
+            self.contents.rename_file('missing.txt', 'bar.txt')
+        assert self.contents.get('bar.txt')['content'] == 'bar'
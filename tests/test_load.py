@@ -0,0 +1,22 @@
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestLoad(TestCase):
+
+    def test_smoke(self):
+        # every operation of the load harness succeeds against a notebook
+        # server running MongoContents (the harness exits with an error
+        # otherwise)
+        result = subprocess.run(
+            [sys.executable, os.path.join(ROOT, 'benchmarks', 'load.py'),
+             '--smoke', '--users', '2', '--dirs', '1', '--files', '2',
+             '--cells', '3', '--file-size', '1024'],
+            env={**os.environ, 'PYTHONPATH': ROOT},
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True, timeout=120)
+        assert result.returncode == 0, result.stdout
@@ -0,0 +1,129 @@
+import os
+import unittest
+from unittest import TestCase
+from pymongo import MongoClient, monitoring
+from pymongo.errors import PyMongoError
+from mongocontents import MongoContents
+
+# the read preference tests need a replica set with at least one secondary,
+# e.g. three mongod's started with --replSet rs0 on ports 27017-27019; they
+# are skipped unless MONGOCONTENTS_TEST_REPLICA_SET_URI is set or such a
+# replica set answers at the default URI
+REPLICA_SET_URI = os.environ.get(
+    'MONGOCONTENTS_TEST_REPLICA_SET_URI',
+    'mongodb://localhost:27017,localhost:27018,localhost:27019/'
+    '?replicaSet=rs0')
+
+
+def secondary_available() -> bool:
+    if 'MONGOCONTENTS_TEST_REPLICA_SET_URI' in os.environ:
+        return True
+    client = MongoClient(REPLICA_SET_URI, serverSelectionTimeoutMS=1000)
+    try:
+        hello = client.admin.command('hello')
+        return 'setName' in hello and len(hello['hosts']) > 1
+    except PyMongoError:
+        return False
+    finally:
+        client.close()
+
+
+class ReadRecorder(monitoring.CommandListener):
+    """Records the collection and server of every read while recording."""
+
+    def __init__(self):
+        self.recording = False
+        self.reads = []
+
+    def started(self, event):
+        if self.recording and event.command_name in ('find', 'aggregate'):
+            self.reads.append((event.command[event.command_name],
+                               event.connection_id))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+recorder = ReadRecorder()
+monitoring.register(recorder)
+
+
+@unittest.skipUnless(secondary_available(), "needs a replica set")
+class TestReadPreference(TestCase):
+    contents: MongoContents
+
+    def setUp(self):
+        self.contents = self.make_contents()
+
+    @staticmethod
+    def make_contents():
+        return MongoContents(mongodb_uri=REPLICA_SET_URI,
+                             listing_read_preference='secondary',
+                             metadata_read_preference='secondary',
+                             content_read_preference='secondary')
+
+    def reset_db(self):
+        self.contents._client.drop_database(self.contents.database_name)
+        self.contents = self.make_contents()
+
+    @staticmethod
+    def fixture1():
+        return {
+            'content': 'Some text',
+            'format': 'text',
+            'mimetype': 'text/plain',
+            'type': 'file'
+        }
+
+    def test_read_preferences(self):
+        self.reset_db()
+        assert self.contents._directories.read_preference.name == 'primary'
+        assert (self.contents._listing_directories.read_preference.name
+                == 'secondary')
+        assert (self.contents._listing_heads.read_preference.name
+                == 'secondary')
+
+    def test_read_your_writes(self):
+        self.reset_db()
+        self.contents.save({'type': 'directory'}, path='mydir')
+        for i in range(20):
+            model = self.fixture1()
+            model['content'] = 'revision {}'.format(i)
+            self.contents.save(model, path='mydir/foo.txt')
+            file = self.contents.get('mydir/foo.txt', type='file')
+            assert file['content'] == model['content']
+        dir = self.contents.get('mydir')
+        assert [item['name'] for item in dir['content']] == ['foo.txt']
+
+    def test_rename_visible(self):
+        self.reset_db()
+        self.contents.save(self.fixture1(), 'foo.txt')
+        self.contents.rename_file('foo.txt', 'bar.txt')
+        assert self.contents.get('bar.txt') is not None
+        assert not self.contents.file_exists('foo.txt')
+        names = [item['name'] for item in self.contents.get('')['content']]
+        assert names == ['bar.txt']
+
+    def test_reads_reach_secondaries(self):
+        self.reset_db()
+        self.contents.save({'type': 'directory'}, path='mydir')
+        self.contents.save(self.fixture1(), 'mydir/foo.txt')
+        primary = self.contents._client.primary
+        recorder.reads = []
+        recorder.recording = True
+        try:
+            self.contents.get('mydir')
+            self.contents.get('mydir/foo.txt')
+        finally:
+            recorder.recording = False
+        files = self.contents.files_collection_name
+        # listings, metadata lookups and content reads all went to
+        # secondaries
+        assert {collection for collection, _ in recorder.reads} == {
+            self.contents.directories_collection_name,
+            self.contents.heads_collection_name,
+            files + '.files', files + '.chunks'}
+        assert all(address != primary for _, address in recorder.reads)
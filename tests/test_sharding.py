@@ -0,0 +1,194 @@
+import os
+import unittest
+from unittest import TestCase
+from pymongo import MongoClient, monitoring
+from pymongo.errors import PyMongoError
+from mongocontents import MongoContents
+from mongocontents.sharding import shard_collections, split_points
+
+# the sharding tests need a mongos in front of a local sharded cluster with at
+# least two shards (e.g. one started with mlaunch init --sharded 2
+# --replicaset); they are skipped unless MONGOCONTENTS_TEST_SHARDED_URI is set
+# or a mongos answers at the default URI
+SHARDED_URI = os.environ.get('MONGOCONTENTS_TEST_SHARDED_URI',
+                             'mongodb://localhost:27017')
+DATABASE = 'jupyter_sharded'
+
+# commands whose routing is checked (inserts are always routed by the shard
+# key of the inserted document)
+ROUTED_COMMANDS = {'find', 'aggregate', 'count', 'distinct', 'findAndModify',
+                   'update', 'delete'}
+
+# session and cluster fields which explain does not accept
+SESSION_FIELDS = {'lsid', 'txnNumber', '$clusterTime', '$db', 'readConcern',
+                  'writeConcern', '$readPreference'}
+
+
+def mongos_available() -> bool:
+    if 'MONGOCONTENTS_TEST_SHARDED_URI' in os.environ:
+        return True
+    client = MongoClient(SHARDED_URI, serverSelectionTimeoutMS=1000)
+    try:
+        return client.admin.command('hello').get('msg') == 'isdbgrid'
+    except PyMongoError:
+        return False
+    finally:
+        client.close()
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """Records the commands sent to the test database while recording."""
+
+    def __init__(self):
+        self.recording = False
+        self.commands = []
+
+    def started(self, event):
+        if self.recording and event.database_name == DATABASE:
+            self.commands.append(dict(event.command))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+recorder = CommandRecorder()
+monitoring.register(recorder)
+
+
+@unittest.skipUnless(mongos_available(), "needs a sharded cluster")
+class TestSharding(TestCase):
+    contents: MongoContents
+
+    def setUp(self):
+        self.contents = self.make_contents()
+
+    @staticmethod
+    def make_contents():
+        return MongoContents(mongodb_uri=SHARDED_URI,
+                             database_name=DATABASE,
+                             shard_key_depth=1)
+
+    def reset_db(self):
+        self.contents._client.drop_database(self.contents.database_name)
+        self.contents = self.make_contents()
+        shard_collections(self.contents)
+
+    def owners(self):
+        """Get two owners whose files live on different shards (the first two,
+        as distributed by shard_collections)."""
+        shards = self.contents._client.admin.command('listShards')['shards']
+        assert len(shards) >= 2, "needs at least two shards"
+        bounds = split_points(len(shards)) + ['g']
+        names = ['user{}'.format(i) for i in range(1000)]
+        low = next(name for name in names
+                   if self.contents._shard('/' + name) < bounds[0])
+        high = next(name for name in names
+                    if bounds[0] <= self.contents._shard('/' + name)
+                    < bounds[1])
+        return low, high
+
+    def explain(self, command) -> list:
+        """Explain a recorded command (each statement of an update or delete
+        on its own)."""
+        database = self.contents._database
+        name = next(iter(command))
+        command = {key: value for key, value in command.items()
+                   if key not in SESSION_FIELDS}
+        statements = {'update': 'updates', 'delete': 'deletes'}.get(name)
+        if statements is None:
+            return [database.command('explain', command)]
+        return [database.command('explain',
+                                 {**command, statements: [statement]})
+                for statement in command[statements]]
+
+    @staticmethod
+    def shards(explanation) -> int:
+        """Get the number of shards an explained command was routed to."""
+        if 'queryPlanner' in explanation:
+            return len(explanation['queryPlanner']['winningPlan']
+                       .get('shards', []))
+        return len(explanation['shards'])
+
+    @staticmethod
+    def fixture1():
+        return {
+            'content': 'Some text',
+            'format': 'text',
+            'mimetype': 'text/plain',
+            'type': 'file'
+        }
+
+    def test_shard_field(self):
+        self.reset_db()
+        self.contents.save({'type': 'directory'}, path='alice')
+        self.contents.save({'type': 'directory'}, path='alice/project')
+        self.contents.save(self.fixture1(), 'alice/project/foo.txt')
+        directory = self.contents._directories.find_one(
+            {'path': '/alice/project'})
+        file = self.contents._files_metadata.find_one(
+            {'filename': '/alice/project/foo.txt'})
+        head = self.contents._heads.find_one(
+            {'path': '/alice/project/foo.txt'})
+        assert directory['shard'] == self.contents._shard('/alice')
+        assert file['metadata']['shard'] == directory['shard']
+        assert head['shard'] == directory['shard']
+
+    def test_basic(self):
+        self.reset_db()
+        low, high = self.owners()
+        for owner in [low, high]:
+            self.contents.save({'type': 'directory'}, path=owner)
+            self.contents.save(self.fixture1(), owner + '/foo.txt')
+        self.contents.rename_file(low + '/foo.txt', high + '/bar.txt')
+        assert self.contents.get(high + '/bar.txt')['content'] == 'Some text'
+        assert not self.contents.file_exists(low + '/foo.txt')
+        names = [item['name'] for item in self.contents.get(high)['content']]
+        assert names == ['bar.txt', 'foo.txt']
+        names = [item['name'] for item in self.contents.get('')['content']]
+        assert names == sorted([low, high])
+        moved = self.contents._files_metadata.find_one(
+            {'filename': '/{}/bar.txt'.format(high)})
+        assert moved['metadata']['shard'] == self.contents._shard('/' + high)
+
+    def test_queries_are_targeted(self):
+        self.reset_db()
+        owners = self.owners()
+        for owner in owners:
+            self.contents.save({'type': 'directory'}, path=owner)
+            self.contents.save({'type': 'directory'}, path=owner + '/project')
+            self.contents.save(self.fixture1(), owner + '/project/foo.txt')
+
+        # the data is spread over both shards, so queries without the shard
+        # key are broadcast
+        for owner in owners:
+            assert self.shards(self.contents._directories.find(
+                {'path': '/{}/project'.format(owner)}).explain()) > 1
+
+        recorder.commands = []
+        recorder.recording = True
+        try:
+            for owner in owners:
+                self.contents.get(owner + '/project')
+                self.contents.get(owner + '/project/foo.txt')
+                self.contents.get(owner + '/project/foo.txt', content=False)
+                self.contents.save(self.fixture1(), owner + '/project/foo.txt')
+                self.contents.rename_file(owner + '/project/foo.txt',
+                                          owner + '/project/bar.txt')
+        finally:
+            recorder.recording = False
+
+        checked = 0
+        for command in recorder.commands:
+            if next(iter(command)) not in ROUTED_COMMANDS:
+                continue
+            if command.get('filter') == {}:
+                # the driver's GridFS checks for an empty collection, made
+                # at the start of every upload
+                continue
+            for explanation in self.explain(command):
+                assert self.shards(explanation) == 1, command
+                checked += 1
+        assert checked > 0
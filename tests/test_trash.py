@@ -0,0 +1,141 @@
+import datetime
+from unittest import TestCase
+from tornado import web
+from mongocontents import MongoContents
+
+
+class TestTrash(TestCase):
+    contents: MongoContents
+
+    def setUp(self):
+        self.contents = MongoContents()
+
+    def reset_db(self):
+        self.contents._client.drop_database(self.contents.database_name)
+        self.contents = MongoContents()
+
+    @staticmethod
+    def fixture1(content='0123456789'):
+        return {
+            'content': content,
+            'format': 'text',
+            'mimetype': 'text/plain',
+            'type': 'file'
+        }
+
+    def test_delete_moves_to_trash(self):
+        self.reset_db()
+        self.contents.save({'type': 'directory'}, path='mydir')
+        self.contents.save(self.fixture1(), 'mydir/foo.txt')
+        self.contents.save(self.fixture1(), 'mydir/bar.txt')
+        self.contents.delete_file('mydir/foo.txt')
+        names = [item['name'] for item in self.contents.get('mydir')['content']]
+        assert names == ['bar.txt']
+        trash = self.contents.list_trash('mydir')
+        assert [entry['path'] for entry in trash] == ['mydir/foo.txt']
+        with self.assertRaises(FileNotFoundError):
+            self.contents.delete_file('mydir/foo.txt')
+
+    def test_live_queries_use_partial_index(self):
+        self.reset_db()
+        self.contents.save(self.fixture1(), 'foo.txt')
+        self.contents.delete_file('foo.txt')
+        explanation = self.contents._heads.find(
+            {'path': '/foo.txt', 'state': 'live'}).explain()
+        assert 'live_path' in str(explanation['queryPlanner'])
+        assert explanation['executionStats']['totalDocsExamined'] == 0
+
+    def test_restore(self):
+        self.reset_db()
+        self.contents.save(self.fixture1('one'), 'foo.txt')
+        self.contents.save(self.fixture1('two'), 'foo.txt')
+        self.contents.delete_file('foo.txt')
+        assert not self.contents.file_exists('foo.txt')
+        model = self.contents.restore_file('foo.txt')
+        assert model['name'] == 'foo.txt'
+        assert self.contents.get('foo.txt')['content'] == 'two'
+        assert self.contents.list_trash() == []
+        with self.assertRaises(web.HTTPError) as context:
+            self.contents.restore_file('foo.txt')
+        assert context.exception.status_code == 404
+
+    def test_restore_conflict(self):
+        self.reset_db()
+        self.contents.save(self.fixture1('one'), 'foo.txt')
+        self.contents.delete_file('foo.txt')
+        self.contents.save(self.fixture1('two'), 'foo.txt')
+        with self.assertRaises(web.HTTPError) as context:
+            self.contents.restore_file('foo.txt')
+        assert context.exception.status_code == 409
+
+    def test_purge(self):
+        self.reset_db()
+        for i in range(5):
+            self.contents.save(self.fixture1(), '{}.txt'.format(i))
+            self.contents.save(self.fixture1(), '{}.txt'.format(i))
+        self.contents.save(self.fixture1(), 'keep.txt')
+        for i in range(5):
+            self.contents.delete_file('{}.txt'.format(i))
+        # nothing is old enough yet
+        assert self.contents.purge_trash() == 0
+        assert self.contents.get_usage()['count'] == 11
+        purged = self.contents.purge_trash(
+            batch_size=2,
+            older_than=datetime.datetime.now() + datetime.timedelta(days=1))
+        assert purged == 5
+        assert self.contents.list_trash() == []
+        assert self.contents._files_metadata.count_documents({}) == 1
+        assert self.contents.get_usage()['count'] == 1
+        assert self.contents.get('keep.txt')['content'] == '0123456789'
+
+    def test_purge_follows_renames(self):
+        self.reset_db()
+        self.contents.save(self.fixture1('one'), 'foo.txt')
+        self.contents.save(self.fixture1('two'), 'foo.txt')
+        self.contents.rename_file('foo.txt', 'bar.txt')
+        self.contents.save(self.fixture1('new'), 'foo.txt')
+        self.contents.delete_file('bar.txt')
+        self.contents.purge_trash(
+            older_than=datetime.datetime.now() + datetime.timedelta(days=1))
+        # both revisions of the renamed file are gone, including the one
+        # stored under its old name; the new file at that name is untouched
+        assert self.contents._files_metadata.count_documents({}) == 1
+        assert len(self.contents.list_revisions('foo.txt')) == 1
+        assert self.contents.get('foo.txt')['content'] == 'new'
+        assert self.contents.get_usage()['count'] == 1
+        assert self.contents.get_usage()['length'] == 3
+
+    def test_migrate_heads(self):
+        self.reset_db()
+        self.contents.save(self.fixture1('one'), 'foo.txt')
+        self.contents.save(self.fixture1('two'), 'foo.txt')
+        self.contents.save(self.fixture1(), 'bar.txt')
+        self.contents.delete_file('bar.txt')
+        # simulate files written by an older version, which marked deleted
+        # files in their metadata
+        self.contents._files_metadata.update_many(
+            {}, {'$unset': {'metadata.schema': ''}})
+        self.contents._files_metadata.update_many(
+            {'filename': '/bar.txt'}, {'$set': {'metadata.deleted': True}})
+        self.contents._heads.delete_many({})
+        with self.assertRaises(RuntimeError):
+            MongoContents()
+        self.contents = MongoContents(migrate_on_start=True)
+        assert self.contents.get('foo.txt')['content'] == 'two'
+        assert len(self.contents.list_revisions('foo.txt')) == 2
+        assert [e['name'] for e in self.contents.list_trash()] == ['bar.txt']
+        # everything is stamped, so it starts normally and has nothing left
+        # to migrate
+        self.contents = MongoContents()
+        assert self.contents.migrate_heads() == 0
+        assert self.contents._heads.count_documents({}) == 2
+
+    def test_delete_is_single_update(self):
+        self.reset_db()
+        self.contents.save(self.fixture1(), 'foo.txt')
+        head = self.contents._heads.find_one({'path': '/foo.txt'})
+        self.contents.delete_file('foo.txt')
+        entry = self.contents._heads.find_one({'path': '/foo.txt'})
+        assert entry['_id'] == head['_id']
+        assert entry['state'] == 'trash'
+        assert entry['file_id'] == head['file_id']
@@ -0,0 +1,146 @@
+import threading
+from unittest import TestCase
+from tornado import web
+from mongocontents import MongoContents
+
+
+class TestUsage(TestCase):
+    contents: MongoContents
+
+    def setUp(self):
+        self.contents = MongoContents()
+
+    def reset_db(self, **kwargs):
+        self.contents._client.drop_database(self.contents.database_name)
+        self.contents = MongoContents(**kwargs)
+
+    @staticmethod
+    def fixture1(content='0123456789'):
+        return {
+            'content': content,
+            'format': 'text',
+            'mimetype': 'text/plain',
+            'type': 'file'
+        }
+
+    def test_usage_rolls_up(self):
+        self.reset_db()
+        self.contents.save({'type': 'directory'}, path='alice')
+        self.contents.save({'type': 'directory'}, path='alice/project')
+        self.contents.save(self.fixture1(), 'alice/project/foo.txt')
+        self.contents.save(self.fixture1(), 'alice/project/foo.txt')
+        self.contents.save(self.fixture1('01234'), 'alice/bar.txt')
+        usage = self.contents.get_usage('alice/project')
+        assert usage['length'] == 20
+        assert usage['count'] == 2
+        assert self.contents.get_usage('alice')['length'] == 25
+        assert self.contents.get_usage('')['length'] == 25
+        assert self.contents.get_usage('bob')['length'] == 0
+
+    def test_rename_moves_usage(self):
+        self.reset_db()
+        self.contents.save({'type': 'directory'}, path='alice')
+        self.contents.save({'type': 'directory'}, path='bob')
+        self.contents.save(self.fixture1(), 'alice/foo.txt')
+        self.contents.rename_file('alice/foo.txt', 'bob/foo.txt')
+        assert self.contents.get_usage('alice')['length'] == 0
+        assert self.contents.get_usage('bob')['length'] == 10
+        assert self.contents.get_usage('')['length'] == 10
+
+    def test_quota(self):
+        self.reset_db(quotas={'alice': 25})
+        self.contents.save({'type': 'directory'}, path='alice')
+        self.contents.save(self.fixture1(), 'alice/foo.txt')
+        self.contents.save(self.fixture1(), 'alice/foo.txt')
+        with self.assertRaises(web.HTTPError) as context:
+            self.contents.save(self.fixture1(), 'alice/foo.txt')
+        assert context.exception.status_code == 507
+        assert self.contents.get_usage('alice')['quota'] == 25
+        # the quota only applies under alice
+        self.contents.save(self.fixture1(), 'foo.txt')
+
+    def test_free_space_under_quota(self):
+        self.reset_db(quotas={'alice': 25})
+        self.contents.save({'type': 'directory'}, path='alice')
+        self.contents.save(self.fixture1(), 'alice/foo.txt')
+        self.contents.save(self.fixture1(), 'alice/foo.txt')
+        with self.assertRaises(web.HTTPError) as context:
+            self.contents.save(self.fixture1(), 'alice/bar.txt')
+        assert context.exception.status_code == 507
+        # dropping the older revision makes room
+        assert self.contents.prune_revisions('alice/foo.txt') == 1
+        assert self.contents.get_usage('alice')['length'] == 10
+        self.contents.save(self.fixture1(), 'alice/bar.txt')
+        # deleted files still count, until the trash is emptied
+        self.contents.delete_file('alice/bar.txt')
+        with self.assertRaises(web.HTTPError):
+            self.contents.save(self.fixture1(), 'alice/baz.txt')
+        assert self.contents.empty_trash('alice') == 1
+        self.contents.save(self.fixture1(), 'alice/baz.txt')
+        assert self.contents.get_usage('alice')['count'] == 2
+
+    def test_prune_keeps_checkpoint(self):
+        self.reset_db(revision_storage='delta', keyframe_interval=3)
+        for i in range(3):
+            self.contents.save(self.fixture1(str(i) * 100), 'foo.txt')
+        checkpoint = self.contents.create_checkpoint('foo.txt')
+        for i in range(3, 6):
+            self.contents.save(self.fixture1(str(i) * 100), 'foo.txt')
+        # the checkpoint (revision 3) and the revisions it is a delta
+        # against stay
+        assert self.contents.prune_revisions('foo.txt') == 2
+        assert len(self.contents.list_revisions('foo.txt')) == 4
+        self.contents.restore_checkpoint(checkpoint['id'], 'foo.txt')
+        assert self.contents.get('foo.txt')['content'] == '2' * 100
+        # the counters follow what is actually stored
+        stored = list(self.contents._files_metadata.find())
+        usage = self.contents.get_usage()
+        assert usage['count'] == len(stored)
+        assert usage['length'] == sum(file['length'] for file in stored)
+
+    def test_reconcile(self):
+        self.reset_db()
+        self.contents.save({'type': 'directory'}, path='alice')
+        for i in range(7):
+            self.contents.save(self.fixture1(), 'alice/{}.txt'.format(i))
+        expected = self.contents.get_usage('alice')
+        self.contents._usage.update_one({'_id': '/alice'},
+                                        {'$set': {'length': 0}})
+        self.contents._usage.insert_one({'_id': '/stale', 'length': 5,
+                                         'count': 1})
+        assert self.contents.reconcile_usage(settle=0.1) == 2
+        assert self.contents.get_usage('alice') == expected
+        assert self.contents.get_usage('stale')['length'] == 0
+
+    def test_reconcile_while_saving(self):
+        self.reset_db()
+        for owner in ['alice', 'bob']:
+            self.contents.save({'type': 'directory'}, path=owner)
+            self.contents.save(self.fixture1(), owner + '/foo.txt')
+        self.contents._usage.update_one({'_id': '/alice'},
+                                        {'$set': {'length': 0}})
+        stop = threading.Event()
+
+        def write():
+            writer = MongoContents()
+            i = 0
+            while not stop.is_set():
+                i += 1
+                writer.save(self.fixture1('x' * i), 'bob/foo.txt')
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        try:
+            self.contents.reconcile_usage(settle=0.05)
+        finally:
+            stop.set()
+            thread.join()
+        # the drifted counter is fixed, and the saves made meanwhile are
+        # neither lost nor counted twice
+        for path in ['/alice', '/bob', '/']:
+            regex = '^' + path.rstrip('/') + '/'
+            stored = list(self.contents._files_metadata.find(
+                {'filename': {'$regex': regex}}))
+            usage = self.contents.get_usage(path.lstrip('/'))
+            assert usage['length'] == sum(file['length'] for file in stored)
+            assert usage['count'] == len(stored)